@@ -1,6 +1,7 @@
 from __future__ import annotations
-import math
 import random
+import numpy as np
+from numpy import ndarray
 from field import Field
 from rule_node import RuleNode
 from typing import TYPE_CHECKING
@@ -11,12 +12,6 @@ if TYPE_CHECKING:
 
 class AllNode(RuleNode):
 
-    def load(self, element: _Element, parent_symmetry: list[bool], grid: Grid) -> bool:
-        if not super().load(element, parent_symmetry, grid):
-            return False
-        self.matches = []
-        return True
-
     def fit(self, r, x, y, z, new_state: list[bool], mx, my):
         rule = self.rules[r]
         for dz in range(rule.omz):
@@ -37,57 +32,117 @@ class AllNode(RuleNode):
                         i = sx + sy * mx + sz * mx * my
                         new_state[i] = True
                         self.grid.state[i] = new_value
-                        self.ip.changes.append((sx, sy, sz))
+                        self.ip.changes.append(i)
 
     def go(self) -> bool:
         # print("AllNode go")
         if not super().go():
             return False
-        self.last_matched_turn = self.ip.counter
+        self.matched()
         if self.trajectory is not None:
             if self.counter >= len(self.trajectory):
                 return False
-            self.grid.state = self.trajectory[self.counter][:len(
+            self.grid.state[:] = self.trajectory[self.counter][:len(
                 self.grid.state)]
+            self.grid.invalidate_planes()
             self.counter += 1
             return True
         if self.match_count == 0:
             return False
         mx, my = self.grid.mx, self.grid.my
+        # 每个匹配的随机数只由(步数, 节点, 规则, 单元格)决定，与匹配在列表中的顺序无关
+        count = self.match_count
+        u = self.ip.counter_random.random(
+            self.ip.counter, self.id, self.matches.rules[:count], self.matches.cells[:count])
         if self.potentials is not None:
-            first_heuristic = 0
-            first_heuristic_computed = False
-            data_list = []
-            for m in range(self.match_count):
-                r, x, y, z = self.matches[m]
-                heuristic = Field.delta_pointwise(
-                    self.grid.state, self.rules[r], x, y, z, self.fields, self.potentials, self.grid.mx, self.grid.my)
-                if heuristic is not None:
-                    if not first_heuristic_computed:
-                        first_heuristic = heuristic
-                        first_heuristic_computed = True
-                    u = self.ip.random.random()
-                    data_list.append((m, u ** math.exp((heuristic - first_heuristic) //
-                                                       self.temperature) if self.temperature > 0 else 0.001 * u - heuristic))
-            ordered = sorted(data_list, key=lambda x: -x[1])
-            for item, _ in ordered:
-                r, x, y, z = self.matches[item]
-                self.match_mask[r, x + y * mx + z * mx * my] = False
+            heuristics, valid = Field.delta_pointwise_all(
+                self.grid.state, self.table, self.matches.rules[:count], self.matches.cells[:count], self.fields, self.potentials)
+            valid = np.flatnonzero(valid)
+            heuristics = heuristics[valid]
+            u = u[valid]
+            if self.temperature > 0:
+                keys = u ** np.exp((heuristics - heuristics[:1]) //
+                                   self.temperature)
+            else:
+                keys = 0.001 * u - heuristics
+            # 稳定排序，键相同的匹配保持原来的顺序
+            ordered = valid[np.argsort(-keys, kind="stable")]
+            if self.grid.numpy:
+                priority = np.full(self.match_count, -1, dtype=np.int64)
+                priority[ordered] = np.arange(len(ordered), 0, -1)
+                self.fit_all(priority)
+                # 与逐个fit相同，只清除已处理的匹配的标记，启发值为None的匹配保留其标记
+                self.matches.unmark_all(
+                    self.matches.rules[valid], self.matches.cells[valid])
+                self.counter += 1
+                self.match_count = 0
+                return True
+            rs, xs, ys, zs = (a.tolist() for a in self.matches.decode())
+            for item in ordered.tolist():
+                r, x, y, z = rs[item], xs[item], ys[item], zs[item]
+                self.matches.unmark(r, x + y * mx + z * mx * my)
                 self.fit(r, x, y, z, self.grid.mask, mx, my)
         else:
-            shuffle = list(range(self.match_count))
-            self.ip.random.shuffle(shuffle)
-            for i in shuffle:
-                r, x, y, z = self.matches[i]
-                self.match_mask[r, x + y * mx + z * mx * my] = False
+            # 按随机数从大到小的顺序处理匹配，相当于一次随机打乱
+            order = np.argsort(-u, kind="stable")
+            if self.grid.numpy:
+                priority = np.empty(count, dtype=np.int64)
+                priority[order] = np.arange(count, 0, -1)
+                self.fit_all(priority)
+                self.counter += 1
+                self.matches.clear()
+                return True
+            rs, xs, ys, zs = (a.tolist() for a in self.matches.decode())
+            for i in order.tolist():
+                r, x, y, z = rs[i], xs[i], ys[i], zs[i]
+                self.matches.unmark(r, x + y * mx + z * mx * my)
                 self.fit(r, x, y, z, self.grid.mask, mx, my)
-        for n in range(self.ip.first[self.last_matched_turn], len(self.ip.changes)):
-            x, y, z = self.ip.changes[n]
-            self.grid.mask[x + y * mx + z * mx * my] = False
+        for n in range(self.ip.step_start, len(self.ip.changes)):
+            self.grid.mask[self.ip.changes[n]] = False
         self.counter += 1
         self.match_count = 0
         return True
 
+    def fit_all(self, priority: ndarray):
+        """
+        fit的向量化版本，需要numpy模式。priority[m]为前match_count个匹配中第m个匹配的优先级，非负的优先级互不相同，负数表示该匹配不参与。
+        结果与按优先级从高到低依次调用fit相同：每一轮选出在其所有写入单元格上优先级最高的存活匹配，
+        再淘汰与被选匹配写入相同单元格的匹配，直到没有存活的匹配。随机优先级下期望只需要O(log n)轮。
+        选出的匹配用scatter写入网格，changes按优先级顺序记录，与逐个fit的结果完全一致。
+        """
+        count = self.match_count
+        alive = priority >= 0
+        matches = np.flatnonzero(alive)
+        owners, cells, values = self.expand(
+            self.matches.rules[matches], self.matches.cells[matches])
+        owners = matches[owners]
+        writes = np.bincount(owners, minlength=count)
+        claimed = self.grid.mask
+        order = np.lexsort((-priority[owners], cells))
+        live_owners, live_cells = owners[order], cells[order]
+        selected = np.zeros(count, dtype=np.bool_)
+        while alive.any():
+            live = alive[live_owners]
+            live_owners, live_cells = live_owners[live], live_cells[live]
+            # 每个单元格上优先级最高的存活写入位于其分组的开头
+            heads = np.ones(len(live_cells), dtype=np.bool_)
+            heads[1:] = live_cells[1:] != live_cells[:-1]
+            chosen = alive & (np.bincount(
+                live_owners[heads], minlength=count) == writes)
+            selected |= chosen
+            alive &= ~chosen
+            claimed[live_cells[chosen[live_owners]]] = True
+            alive[live_owners[claimed[live_cells]]] = False
+        for r in np.unique(self.matches.rules[:count][selected]).tolist():
+            self.last[r] = True
+        keep = selected[owners]
+        owners, cells, values = owners[keep], cells[keep], values[keep]
+        order = np.argsort(-priority[owners], kind="stable")
+        cells, values = cells[order], values[order]
+        self.grid.state[cells] = values
+        claimed[cells] = False
+        self.ip.changes.extend(cells)
+
 
 if __name__ == "__main__":
     a = list(range(5))
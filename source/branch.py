@@ -87,6 +87,18 @@ class MarkovNode(Branch):
         node.grid = ip.grid
         return node
 
+    def load(self, element: _Element, parent_symmetry: list[bool], grid: Grid) -> bool:
+        from one_node import OneNode
+        if not super().load(element, parent_symmetry, grid):
+            return False
+        for node in self.nodes[1:]:
+            if isinstance(node, OneNode) and node.batch > 1:
+                # 每一步都会先重新尝试前面的子节点，批量执行会改变分布
+                print(
+                    f"batch is only supported on the first node of a markov, ignoring batch=\"{node.batch}\"")
+                node.batch = 1
+        return True
+
     def go(self) -> bool:
         # print("MarkovNode go")
         self.n = 0
@@ -0,0 +1,93 @@
+from __future__ import annotations
+import numpy as np
+from array import array
+
+
+class ChangeLog:
+    """
+    Interpreter.changes的实现：按发生顺序记录网格中发生变化的单元格的一维索引x + y * mx + z * mx * my，存储为可增长的int32数组。
+    同一步内多次变化的单元格只记录第一次，因此重新扫描时每个单元格只处理一次。
+
+    索引是从运行开始计数的绝对索引。需要读取变化的节点通过watch登记自己的游标，每步结束时丢弃最慢游标之前的记录，
+    但最多保留capacity条，游标落在已丢弃部分的节点需要重新扫描整个网格。
+    """
+
+    def __init__(self, capacity=1 << 22) -> None:
+        self.data = array("i")
+
+        self.offset = 0
+        """data[0]的绝对索引，更早的记录已被丢弃"""
+
+        self.capacity = capacity
+        """每步结束后最多保留的记录数"""
+
+        self.cursors = {}
+        """节点到其下次需要读取的第一条记录的绝对索引"""
+
+        self.seen = set()
+        """本步中已记录的单元格"""
+
+    def __len__(self):
+        """已记录的变化总数，即下一条记录的绝对索引"""
+        return self.offset + len(self.data)
+
+    def __getitem__(self, n):
+        return self.data[n - self.offset]
+
+    def append(self, i):
+        if i not in self.seen:
+            self.seen.add(i)
+            self.data.append(i)
+
+    def extend(self, cells: np.ndarray):
+        """按顺序记录一组单元格（一维索引数组），等价于对每个单元格调用append"""
+        items = cells.tolist()
+        fresh = set(items)
+        if not self.seen and len(fresh) == len(items):
+            # 本步的第一批记录且没有重复，可以整体追加
+            self.seen = fresh
+            self.data.frombytes(cells.astype(np.int32).tobytes())
+            return
+        seen = self.seen
+        data = self.data
+        for i in items:
+            if i not in seen:
+                seen.add(i)
+                data.append(i)
+
+    def watch(self, owner, start):
+        """登记owner需要读取从绝对索引start开始的记录"""
+        self.cursors[owner] = start
+
+    def cursor(self, owner):
+        """返回owner登记的游标，未登记时返回-1"""
+        return self.cursors.get(owner, -1)
+
+    def release(self, owner):
+        self.cursors.pop(owner, None)
+
+    def available(self, start) -> bool:
+        """从绝对索引start开始的记录是否仍然完整"""
+        return start >= self.offset
+
+    def end_step(self):
+        """一步结束时调用，之后的变化重新开始去重，并丢弃所有游标都不再需要的记录"""
+        self.seen.clear()
+        end = len(self)
+        start = max(min(self.cursors.values(), default=end),
+                    end - self.capacity)
+        # 累计丢弃的记录足够多时才移动数据，均摊O(1)
+        dead = start - self.offset
+        if dead > 0 and dead >= len(self.data) // 2:
+            del self.data[:dead]
+            self.offset = start
+
+    def clear(self):
+        self.data = array("i")
+        self.offset = 0
+        self.cursors.clear()
+        self.seen.clear()
+
+    def since(self, start) -> np.ndarray:
+        """返回从绝对索引start开始的所有变化，为独立的int32数组"""
+        return np.frombuffer(self.data[start - self.offset:], dtype=np.int32)
@@ -74,6 +74,7 @@ class ConvChainNode(Node):
                         0, 1) == 0 else self.c1
                     self.substrate[i] = True
                     any_substrate = True
+            self.grid.invalidate_planes()
             self.counter += 1
             return any_substrate
         for _ in state:
@@ -111,6 +112,7 @@ class ConvChainNode(Node):
                 q = q ** (1.0 / self.temperature)
             if q > self.ip.random.random():
                 self.toggle(state, r)
+        self.grid.invalidate_planes()
         self.counter += 1
         return True
 
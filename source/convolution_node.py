@@ -113,6 +113,8 @@ class ConvolutionNode(Node):
                         self.grid.state[i] = rule.output
                         change = True
                         break
+        if change:
+            self.grid.invalidate_planes()
         self.counter += 1
         return change
 
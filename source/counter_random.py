@@ -0,0 +1,75 @@
+from __future__ import annotations
+import numpy as np
+from numpy import ndarray
+from grid import njit, HAS_NUMBA
+
+MASK = 0xFFFFFFFF
+M0, M1 = 0xD2511F53, 0xCD9E8D57
+"""Philox4x32的乘数"""
+W0, W1 = 0x9E3779B9, 0xBB67AE85
+"""每轮密钥的增量"""
+ROUNDS = 10
+
+U32 = np.uint64(32)
+UMASK, UM0, UM1, UW0, UW1 = (np.uint64(v) for v in (MASK, M0, M1, W0, W1))
+
+
+@njit(cache=True)
+def philox_kernel(k0, k1, c1, c2, lanes, cells, out):
+    """CounterRandom.random的编译版本，所有整数都是np.uint64，结果与numpy版本逐位相同"""
+    for i in range(cells.shape[0]):
+        x0, x1, x2, x3 = cells[i], c1, c2, lanes[i]
+        a, b = k0, k1
+        for _ in range(ROUNDS):
+            p0 = x0 * UM0
+            p1 = x2 * UM1
+            x0, x1, x2, x3 = (p1 >> U32) ^ x1 ^ a, p1 & UMASK, (p0 >> U32) ^ x3 ^ b, p0 & UMASK
+            a = (a + UW0) & UMASK
+            b = (b + UW1) & UMASK
+        out[i] = ((x0 >> np.uint64(5)) * np.uint64(67108864) + (x1 >> np.uint64(6))) / 9007199254740992.0
+
+
+class CounterRandom:
+    """
+    基于计数器的随机数生成器(Philox4x32-10)，由Interpreter按种子创建。
+    每个随机数由(步数, 节点编号, 通道, 单元格)唯一确定，与抽取的顺序和次数无关，
+    因此向量化或并行的内核可以为每个单元格独立抽取随机数，给定种子时结果仍然完全确定。
+    通道用于区分同一单元格上的多个随机数，例如不同规则的匹配。
+    """
+
+    def __init__(self, seed) -> None:
+        seed &= (1 << 64) - 1
+        self.k0 = seed & MASK
+        self.k1 = seed >> 32
+
+    def random(self, step, node, lanes, cells: ndarray) -> ndarray:
+        """返回[0, 1)中的float64数组，第k个随机数由(step, node, lanes[k], cells[k])确定，lanes也可以是标量"""
+        cells = np.asarray(cells).astype(np.uint64)
+        lanes = np.broadcast_to(np.asarray(lanes).astype(np.uint64), cells.shape)
+        c1, c2 = np.uint64(step & MASK), np.uint64(node & MASK)
+        if HAS_NUMBA:
+            out = np.empty(cells.shape, dtype=np.float64)
+            philox_kernel(np.uint64(self.k0), np.uint64(self.k1), c1, c2,
+                          np.ascontiguousarray(lanes), cells, out)
+            return out
+        x0, x1, x2, x3 = cells, np.full(cells.shape, c1), np.full(cells.shape, c2), lanes
+        a, b = self.k0, self.k1
+        for _ in range(ROUNDS):
+            p0 = x0 * UM0
+            p1 = x2 * UM1
+            x0, x1, x2, x3 = (p1 >> U32) ^ x1 ^ np.uint64(a), p1 & UMASK, (p0 >> U32) ^ x3 ^ np.uint64(b), p0 & UMASK
+            a = (a + W0) & MASK
+            b = (b + W1) & MASK
+        return ((x0 >> np.uint64(5)) * np.uint64(67108864) + (x1 >> np.uint64(6))) / 9007199254740992.0
+
+    def random1(self, step, node, lane, cell) -> float:
+        """random的标量版本，用Python整数计算，结果与random相同"""
+        x0, x1, x2, x3 = cell, step & MASK, node & MASK, lane
+        a, b = self.k0, self.k1
+        for _ in range(ROUNDS):
+            p0 = x0 * M0
+            p1 = x2 * M1
+            x0, x1, x2, x3 = (p1 >> 32) ^ x1 ^ a, p1 & MASK, (p0 >> 32) ^ x3 ^ b, p0 & MASK
+            a = (a + W0) & MASK
+            b = (b + W1) & MASK
+        return ((x0 >> 5) * 67108864 + (x1 >> 6)) / 9007199254740992.0
@@ -1,12 +1,71 @@
 from __future__ import annotations
+import heapq
+import numpy as np
+from collections import deque
 from numpy import ndarray
+from grid import njit
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from lxml.etree import _Element
-    from rule import Rule
+    from rule import RuleTable
     from grid import Grid
 
 
+@njit(cache=True)
+def distance_kernel(state, zero, substrate, mx, my, mz, potential):
+    """Field.compute的编译版本，zero和substrate为颜色bitmask，用预先分配的数组作为队列"""
+    n = state.shape[0]
+    queue = np.empty(n, dtype=np.int32)
+    head = tail = 0
+    for i in range(n):
+        if (zero >> state[i]) & 1 == 1:
+            potential[i] = 0
+            queue[tail] = i
+            tail += 1
+        else:
+            potential[i] = -1
+    if tail == 0:
+        return False
+    plane = mx * my
+    while head < tail:
+        i = queue[head]
+        head += 1
+        t = potential[i] + 1
+        x = i % mx
+        y = (i // mx) % my
+        z = i // plane
+        for k in range(6):
+            if k == 0:
+                if x == 0:
+                    continue
+                j = i - 1
+            elif k == 1:
+                if x == mx - 1:
+                    continue
+                j = i + 1
+            elif k == 2:
+                if y == 0:
+                    continue
+                j = i - mx
+            elif k == 3:
+                if y == my - 1:
+                    continue
+                j = i + mx
+            elif k == 4:
+                if z == 0:
+                    continue
+                j = i - plane
+            else:
+                if z == mz - 1:
+                    continue
+                j = i + plane
+            if potential[j] == -1 and (substrate >> state[j]) & 1 == 1:
+                potential[j] = t
+                queue[tail] = j
+                tail += 1
+    return True
+
+
 class Field:
 
     def __init__(self, element: _Element, grid: Grid) -> None:
@@ -30,81 +89,176 @@ class Field:
         self.zero = grid.wave(zero_symbols)
         """势场中零点的颜色bitmask，potentials是经过substrate单元格到zero的最短路径"""
 
+        self.sources = 0
+        """上次compute或update之后网格中零点颜色的单元格数量"""
+
+        self.unlogged = -1
+        """上次compute时网格的unlogged计数，不同时网格有未记录在changes中的更改，update无法局部修复"""
+
     def compute(self, potential: ndarray, grid: Grid):
+        """
+        用广度优先搜索计算势场：zero颜色的单元格为0，其余单元格为只经过substrate颜色的单元格到zero的最短距离，不可达为-1。
+        没有zero颜色的单元格时返回False。
+        """
+        self.unlogged = grid.unlogged
+        if grid.compiled():
+            success = distance_kernel(grid.state, self.zero, self.substrate, grid.mx, grid.my, grid.mz, potential)
+            self.sources = int(np.count_nonzero(potential == 0))
+            return success
         mx, my, mz = grid.mx, grid.my, grid.mz
-        front = []
-        ix = iy = iz = 0
-        for i, value in enumerate(grid.state):
-            potential[i] = -1
-            if (self.zero & 1 << value) != 0:
-                potential[i] = 0
-                front.append((0, ix, iy, iz))
-            ix += 1
-            if ix == mx:
-                ix = 0
-                iy += 1
-                if iy == my:
-                    iy = 0
-                    iz += 1
+        zero = [(self.zero >> v) & 1 == 1 for v in range(grid.c)]
+        substrate = [(self.substrate >> v) & 1 == 1 for v in range(grid.c)]
+        state = [int(v) for v in grid.state]
+        distance = [-1] * len(state)
+        front = deque()
+        for i, value in enumerate(state):
+            if zero[value]:
+                distance[i] = 0
+                front.append(i)
+        self.sources = len(front)
         if not front:
+            potential[:] = distance
             return False
+        plane = mx * my
         while front:
-            t, x, y, z = front.pop(0)
-            neighbors = __class__.neighbors(x, y, z, mx, my, mz)
-            for nx, ny, nz in neighbors:
-                i = nx + ny * mx + nz * mx * my
-                v = grid.state[i]
-                if potential[i] == -1 and (self.substrate & 1 << v) != 0:
-                    front.append((t + 1, nx, ny, nz))
-                    potential[i] = t + 1
+            i = front.popleft()
+            t = distance[i] + 1
+            x = i % mx
+            y = (i // mx) % my
+            z = i // plane
+            # 依次为x - 1, x + 1, y - 1, y + 1, z - 1, z + 1方向的邻居
+            for ok, n in ((x > 0, i - 1), (x < mx - 1, i + 1), (y > 0, i - mx),
+                          (y < my - 1, i + mx), (z > 0, i - plane), (z < mz - 1, i + plane)):
+                if ok and distance[n] == -1 and substrate[state[n]]:
+                    distance[n] = t
+                    front.append(n)
+        potential[:] = distance
         return True
 
+    def update(self, potential: ndarray, grid: Grid, changes: ndarray):
+        """
+        在上次compute或update之后，根据其间发生变化的单元格（一维索引数组，可以有重复）局部修复势场，结果与重新compute相同。
+        先按原距离从小到大传播失效：一个单元格的所有距离小1的邻居都失效时它也失效；再从失效区域的有效边界和新的零点重新扩展，
+        同时向外传播变小的距离。涉及的单元格过多或网格有未记录的更改（卷积、轨迹回放等）时改为重新compute。
+        """
+        if self.unlogged != grid.unlogged:
+            return self.compute(potential, grid)
+        mx, my, mz = grid.mx, grid.my, grid.mz
+        zero = [(self.zero >> v) & 1 == 1 for v in range(grid.c)]
+        substrate = [(self.substrate >> v) & 1 == 1 for v in range(grid.c)]
+        state = grid.state
+        # 编译的compute比Python的局部修复快得多，此时只在修复区域很小时才值得修复
+        budget = len(state) // (256 if grid.compiled() else 32)
+        invalid = set(changes.tolist())
+        budget -= len(invalid)
+        if budget < 0:
+            return self.compute(potential, grid)
+        heap = []
+        for i in invalid:
+            t = int(potential[i])
+            if t == 0:
+                self.sources -= 1
+            if zero[state[i]]:
+                self.sources += 1
+            if t >= 0:
+                heap.append((t, i))
+        heapq.heapify(heap)
+        while heap:
+            t, i = heapq.heappop(heap)
+            for n in __class__.adjacent(i, mx, my, mz):
+                if n in invalid or potential[n] != t + 1:
+                    continue
+                if all(m in invalid or potential[m] != t for m in __class__.adjacent(n, mx, my, mz)):
+                    invalid.add(n)
+                    budget -= 1
+                    if budget < 0:
+                        return self.compute(potential, grid)
+                    heapq.heappush(heap, (t + 1, n))
+        for i in invalid:
+            potential[i] = -1
+        for i in invalid:
+            if zero[state[i]]:
+                potential[i] = 0
+                heap.append((0, i))
+            else:
+                for n in __class__.adjacent(i, mx, my, mz):
+                    t = int(potential[n])
+                    if t >= 0 and n not in invalid:
+                        heap.append((t, n))
+        heapq.heapify(heap)
+        while heap:
+            t, i = heapq.heappop(heap)
+            if potential[i] != t:
+                continue
+            for n in __class__.adjacent(i, mx, my, mz):
+                d = potential[n]
+                if (d == -1 or d > t + 1) and substrate[state[n]]:
+                    potential[n] = t + 1
+                    heapq.heappush(heap, (t + 1, n))
+                    budget -= 1
+                    if budget < 0:
+                        return self.compute(potential, grid)
+        return self.sources > 0
+
     @staticmethod
-    def neighbors(x, y, z, mx, my, mz):
+    def adjacent(i, mx, my, mz):
+        """返回一维索引为i的单元格在网格内的各个邻居的一维索引"""
+        plane = mx * my
+        x = i % mx
+        y = (i // mx) % my
+        z = i // plane
         result = []
         if x > 0:
-            result.append((x - 1, y, z))
+            result.append(i - 1)
         if x < mx - 1:
-            result.append((x + 1, y, z))
+            result.append(i + 1)
         if y > 0:
-            result.append((x, y - 1, z))
+            result.append(i - mx)
         if y < my - 1:
-            result.append(((x, y + 1, z)))
+            result.append(i + mx)
         if z > 0:
-            result.append((x, y, z - 1))
+            result.append(i - plane)
         if z < mz - 1:
-            result.append((x, y, z + 1))
+            result.append(i + plane)
         return result
 
     @staticmethod
-    def delta_pointwise(state: list[int], rule: Rule, x, y, z, fields: list[Field], potentials: ndarray, mx, my):
-        sum = 0
-        dx = dy = dz = 0
-        for input_value, new_value in zip(rule.input, rule.output):
-            if new_value != 255 and (input_value & 1 << new_value) == 0:
-                i = x + dx + (y + dy) * mx + (z + dz) * mx * my
-                new_potential = potentials[new_value, i]
-                if new_potential == -1:
-                    return None
-                old_value = state[i]
-                old_potential = potentials[old_value, i]
-                sum += new_potential - old_potential
-                if fields is not None:
-                    old_field = fields[old_value]
-                    if old_field is not None and old_field.inversed:
-                        sum += 2 * old_potential
-                    new_field = fields[new_value]
-                    if new_field is not None and new_field.inversed:
-                        sum -= 2 * new_potential
-            dx += 1
-            if dx == rule.imx:
-                dx = 0
-                dy += 1
-                if dy == rule.imy:
-                    dy = 0
-                    dz += 1
-        return sum
-
+    def delta_pointwise_all(state: list[int], table: RuleTable, rs: ndarray, cells: ndarray, fields: list[Field], potentials: ndarray):
+        """
+        对匹配(rs[m], cells[m])一次计算所有启发值，cells为匹配位置的一维索引，只考虑table中一定会改变单元格的写入。
+        返回(heuristics, valid)两个数组：valid[m]为False时第m个匹配会写入势为-1的颜色，此时heuristics[m]没有意义。
+        """
+        heuristics = np.zeros(len(rs), dtype=np.float64)
+        valid = np.ones(len(rs), dtype=np.bool_)
+        inversed = np.array([fields is not None and fields[c] is not None and fields[c].inversed
+                             for c in range(len(potentials))], dtype=np.bool_)
+        bases = cells.astype(np.int64)
+        order = np.argsort(rs, kind="stable")
+        bounds = np.searchsorted(rs[order], np.arange(table.count + 1))
+        for r in range(table.count):
+            group = order[bounds[r]:bounds[r + 1]]
+            if len(group) == 0:
+                continue
+            lo, hi = table.write_offsets[r], table.write_offsets[r + 1]
+            changes = table.write_changes[lo:hi]
+            if not changes.any():
+                continue
+            deltas = table.write_deltas[lo:hi][changes]
+            targets = bases[group, None] + deltas[None, :]
+            new = np.broadcast_to(
+                table.write_values[lo:hi][changes].astype(np.int64), targets.shape)
+            if isinstance(state, np.ndarray):
+                old = state[targets]
+            else:
+                old = np.array([state[i] for i in targets.ravel().tolist()],
+                               dtype=np.int64).reshape(targets.shape)
+            new_potential = potentials[new, targets]
+            old_potential = potentials[old, targets]
+            delta = new_potential - old_potential + 2 * old_potential * \
+                inversed[old] - 2 * new_potential * inversed[new]
+            heuristics[group] = delta.sum(axis=1)
+            valid[group] = (new_potential != -1).all(axis=1)
+        return heuristics, valid
 
 if __name__ == "__main__":
     a = 3 << 2 & 0
@@ -1,17 +1,93 @@
-from numba import njit
+from __future__ import annotations
+import numpy as np
 from lxml.etree import _Element
 from rule import Rule
 from helper import Helper
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from change_log import ChangeLog
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """numba不可用时的占位装饰器，被装饰的函数不会被使用"""
+        return lambda f: f
+
+
+@njit(cache=True)
+def matches_kernel(state, inputs, start, imx, imy, imz, x, y, z, mx, my):
+    """Grid.matches的编译版本，inputs[start:]为规则的输入bitmask"""
+    i = start
+    for dz in range(imz):
+        for dy in range(imy):
+            for dx in range(imx):
+                if (inputs[i] >> state[x + dx + (y + dy) * mx + (z + dz) * mx * my]) & 1 == 0:
+                    return False
+                i += 1
+    return True
+
+
+@njit(cache=True)
+def rescan_kernel(state, changes, mx, my, mz, shapes, input_offsets, inputs, color_offsets, color_shifts, match_mask):
+    """
+    对一批发生变化的单元格（一维索引）重新扫描相关规则，返回新匹配(r, 一维位置)组成的int32数组，并在match_mask（MatchList.mask的位集）中标记。
+    规则参数为RuleTable中的shapes, input_offsets, inputs, color_offsets, color_shifts，每个单元格只访问其新颜色对应的(规则, 偏移)对。
+    遍历顺序与RuleNode.go中的Python循环一致，因此结果顺序也一致。
+    """
+    result = np.empty((64, 2), dtype=np.int32)
+    n = 0
+    for k in range(changes.shape[0]):
+        i = changes[k]
+        x, y, z = i % mx, (i // mx) % my, i // (mx * my)
+        value = state[i]
+        for j in range(color_offsets[value], color_offsets[value + 1]):
+            r = color_shifts[j, 0]
+            imx, imy, imz = shapes[r, 0], shapes[r, 1], shapes[r, 2]
+            sx = x - color_shifts[j, 1]
+            sy = y - color_shifts[j, 2]
+            sz = z - color_shifts[j, 3]
+            if sx < 0 or sy < 0 or sz < 0 or (sx + imx) > mx or (sy + imy) > my or (sz + imz) > mz:
+                continue
+            si = sx + sy * mx + sz * mx * my
+            bit = 1 << (si & 7)
+            if match_mask[r, si >> 3] & bit == 0 and matches_kernel(state, inputs, input_offsets[r], imx, imy, imz, sx, sy, sz, mx, my):
+                match_mask[r, si >> 3] |= bit
+                if n == result.shape[0]:
+                    grown = np.empty((2 * n, 2), dtype=np.int32)
+                    grown[:n] = result
+                    result = grown
+                result[n, 0] = r
+                result[n, 1] = si
+                n += 1
+    return result[:n]
 
 
 class Grid:
 
-    def __init__(self, element: _Element, mx, my, mz) -> None:
+    def __init__(self, element: _Element, mx, my, mz, numpy=False, bitplanes=False) -> None:
         self.mx = mx
         self.my = my
         self.mz = mz
         self.c = 0
 
+        self.numpy = numpy
+        """为True时，state、state_buffer和mask使用连续的np.uint8/np.bool_数组存储，而不是Python列表"""
+
+        self.bitplanes = bitplanes
+        """为True时，额外维护按位打包的颜色平面planes，用于按64位字宽匹配规则，需要numpy模式"""
+
+        self.planes = None
+        """形状为(c, mz, my, ceil(mx / 64))的uint64数组，planes[v, z, y]的第x位为1当且仅当(x, y, z)处的颜色为v"""
+
+        self.planes_synced = -1
+        """planes已同步的Interpreter.changes条目数，-1表示下次使用前需要根据state重建"""
+
+        self.unlogged = 0
+        """以不记录到Interpreter.changes的方式修改state的次数，由invalidate_planes递增，依赖changes增量维护的状态据此判断是否需要重建"""
+
         self.values = {}
         """颜色字符与索引的map"""
 
@@ -34,10 +110,19 @@ class Grid:
         if color_string is None:
             raise Exception("no values specified")
         self.c = len(color_string)
+        if self.numpy and self.c > 256:
+            raise Exception(f"too many values for a uint8 grid: {self.c}")
+        if self.bitplanes and not self.numpy:
+            raise Exception("bitplanes require a numpy grid")
         size = self.mx * self.my * self.mz
-        self.state = [0] * size
-        self.state_buffer = [0] * size
-        self.mask = [False] * size
+        if self.numpy:
+            self.state = np.zeros(size, dtype=np.uint8)
+            self.state_buffer = np.zeros(size, dtype=np.uint8)
+            self.mask = np.zeros(size, dtype=np.bool_)
+        else:
+            self.state = [0] * size
+            self.state_buffer = [0] * size
+            self.mask = [False] * size
         for i, symbol in enumerate(color_string):
             if symbol in self.waves:
                 raise Exception(f"repeating value \"{symbol}\"")
@@ -61,7 +146,53 @@ class Grid:
         self.folder = element.get("folder")
 
     def clear(self):
-        self.state = [0] * len(self.state)
+        if self.numpy:
+            # 原地清零，保证已取得的视图依然有效
+            self.state.fill(0)
+        else:
+            self.state = [0] * len(self.state)
+        self.invalidate_planes()
+
+    def invalidate_planes(self):
+        """以不记录到Interpreter.changes的方式修改state后调用，planes将在下次同步时重建"""
+        self.planes_synced = -1
+        self.unlogged += 1
+
+    def sync_planes(self, changes: ChangeLog):
+        """将changes中尚未同步的条目增量写入planes，变化过多或planes已失效时根据state重建"""
+        pending = len(changes) - self.planes_synced
+        if self.planes_synced < 0 or pending < 0 or not changes.available(self.planes_synced) or pending * 64 > len(self.state):
+            self.build_planes()
+        elif pending > 0:
+            mx, my = self.mx, self.my
+            cells = np.unique(changes.since(self.planes_synced))
+            xs, ys, zs = cells % mx, (cells // mx) % my, cells // (mx * my)
+            words = xs >> 6
+            bits = np.left_shift(np.uint64(1), (xs & 63).astype(np.uint64))
+            values = self.state[cells]
+            for v in range(self.c):
+                np.bitwise_and.at(self.planes[v], (zs, ys, words), ~bits)
+            np.bitwise_or.at(self.planes, (values, zs, ys, words), bits)
+        self.planes_synced = len(changes)
+
+    def build_planes(self):
+        words = (self.mx + 63) // 64
+        padded = np.zeros((self.mz, self.my, words * 64), dtype=np.bool_)
+        state = self.view()
+        self.planes = np.empty((self.c, self.mz, self.my, words), dtype=np.uint64)
+        for v in range(self.c):
+            padded[:, :, :self.mx] = state == v
+            self.planes[v] = np.packbits(
+                padded, axis=-1, bitorder="little").view("<u8")
+
+    def view(self, a=None):
+        """
+        返回形状为(mz, my, mx)的三维数组，默认为state。numpy模式下是零拷贝视图，对它的写入会直接反映到网格中；
+        列表模式下只是一份拷贝。
+        """
+        a = self.state if a is None else a
+        dtype = np.bool_ if a is self.mask else np.uint8
+        return np.asarray(a, dtype=dtype).reshape(self.mz, self.my, self.mx)
 
     def wave(self, values):
         """将颜色字符串解析为bitmask"""
@@ -74,7 +205,7 @@ class Grid:
         """判断规则的输入pattern是否与此网格中的给定位置匹配。该位置必须使得整个输入pattern都在界内。"""
         dx = dy = dz = 0
         for item in rule.input:
-            if (item & 1 << self.state[x + dx + (y + dy) * self.mx + (z + dz) * self.mx * self.my]) == 0:
+            if (item & 1 << int(self.state[x + dx + (y + dy) * self.mx + (z + dz) * self.mx * self.my])) == 0:
                 return False
             dx += 1
             if dx == rule.imx:
@@ -85,6 +216,81 @@ class Grid:
                     dz += 1
         return True
 
+    def compiled(self):
+        """增量匹配能否使用编译的内核：需要numba，state为numpy数组，且颜色bitmask能放进int64"""
+        return HAS_NUMBA and self.numpy and self.c < 64
+
+    def match_map(self, rule: Rule, state=None):
+        """
+        对整个网格一次性计算规则的匹配图，返回形状为(mz - imz + 1, my - imy + 1, mx - imx + 1)的布尔数组，
+        当且仅当matches(rule, x, y, z)为True时，对应元素[z, y, x]为True。state为view()返回的三维数组，可复用于多个规则。
+        """
+        state = self.view() if state is None else state
+        mx, my, mz = self.mx - rule.imx + 1, self.my - rule.imy + 1, self.mz - rule.imz + 1
+        if mx <= 0 or my <= 0 or mz <= 0:
+            return np.zeros((max(mz, 0), max(my, 0), max(mx, 0)), dtype=np.bool_)
+        result = np.ones((mz, my, mx), dtype=np.bool_)
+        wildcard = (1 << self.c) - 1
+        allowed = {}
+        """输入bitmask对应的布尔查找表应用于整个网格的结果，相同的bitmask只计算一次"""
+        dx = dy = dz = 0
+        for item in rule.input:
+            if item & wildcard != wildcard:
+                if item not in allowed:
+                    lut = np.array([(item >> v) & 1 for v in range(self.c)], dtype=np.bool_)
+                    allowed[item] = lut[state]
+                result &= allowed[item][dz:dz + mz, dy:dy + my, dx:dx + mx]
+            dx += 1
+            if dx == rule.imx:
+                dx = 0
+                dy += 1
+                if dy == rule.imy:
+                    dy = 0
+                    dz += 1
+        return result
+
+    def plane_match_map(self, rule: Rule):
+        """
+        match_map的位平面版本，每次按位运算同时处理一行中的64个单元格。
+        调用前需要先用sync_planes使planes与state一致。
+        """
+        mx, my, mz = self.mx - rule.imx + 1, self.my - rule.imy + 1, self.mz - rule.imz + 1
+        if mx <= 0 or my <= 0 or mz <= 0:
+            return np.zeros((max(mz, 0), max(my, 0), max(mx, 0)), dtype=np.bool_)
+        words = self.planes.shape[3]
+        extra = (rule.imx + 63) // 64
+        result = np.full((mz, my, words), ~np.uint64(0), dtype=np.uint64)
+        wildcard = (1 << self.c) - 1
+        allowed = {}
+        """输入bitmask允许的颜色平面之并，末尾补零以便跨字移位"""
+        dx = dy = dz = 0
+        for item in rule.input:
+            if item & wildcard != wildcard:
+                if item not in allowed:
+                    union = np.zeros(
+                        (self.mz, self.my, words + extra), dtype=np.uint64)
+                    for v in range(self.c):
+                        if (item >> v) & 1 == 1:
+                            union[:, :, :words] |= self.planes[v]
+                    allowed[item] = union
+                window = allowed[item][dz:dz + mz, dy:dy + my]
+                q, r = divmod(dx, 64)
+                shifted = window[:, :, q:q + words]
+                if r > 0:
+                    shifted = (shifted >> np.uint64(r)) | (
+                        window[:, :, q + 1:q + 1 + words] << np.uint64(64 - r))
+                result &= shifted
+            dx += 1
+            if dx == rule.imx:
+                dx = 0
+                dy += 1
+                if dy == rule.imy:
+                    dy = 0
+                    dz += 1
+        bits = np.unpackbits(result.astype("<u8").view(
+            np.uint8), axis=-1, bitorder="little")
+        return bits[:, :, :mx].astype(np.bool_)
+
 
 if __name__ == "__main__":
 
@@ -5,6 +5,8 @@ from random import Random
 from lxml import etree
 from lxml.etree import _Element
 from grid import Grid
+from change_log import ChangeLog
+from counter_random import CounterRandom
 from symmetry_helper import SymmetryHelper
 from node_factory import NodeFactory
 from branch import Branch
@@ -13,7 +15,7 @@ from branch import MarkovNode
 
 class Interpreter:
 
-    def __init__(self, file_name, mx, my, mz) -> None:
+    def __init__(self, file_name, mx, my, mz, numpy=False, bitplanes=False) -> None:
         self.mx = mx
         self.my = my
         self.mz = mz
@@ -21,20 +23,36 @@ class Interpreter:
         self.counter = 0
         self.root = None
         self.current = None
-        self.changes = []
-        self.first = []
-        """Interpreter.changes 列表对应的索引列表。first[i] 是在程序执行的第 i 步之后发生的网格第一次更改的索引。"""
+        self.changes = ChangeLog()
+        """网格中发生变化的单元格的一维索引，同一步内重复的变化只记录一次"""
+
+        self.step_start = 0
+        """当前步中网格第一次更改在changes中的绝对索引"""
 
         self.random: Random = None
+
+        self.counter_random: CounterRandom = None
+        """按种子创建的基于计数器的随机数生成器，供需要为每个单元格独立抽取随机数的向量化代码使用"""
+
+        self.node_count = 0
+        """已创建的节点数量，用于为节点分配编号"""
+
         self.origin = None
         self.start_grid = None
         self.grid: Grid = None
+
+        self.numpy = numpy
+        """是否使用numpy数组存储网格状态，见Grid.numpy"""
+
+        self.bitplanes = bitplanes
+        """是否为网格维护按位打包的颜色平面，见Grid.bitplanes"""
+
         self.load(file_name, mx, my, mz)
 
     def load(self, file_name, mx, my, mz):
         element: _Element = etree.parse(file_name).getroot()
         self.origin = element.get("origin", False)
-        self.grid = Grid(element, mx, my, mz)
+        self.grid = Grid(element, mx, my, mz, self.numpy, self.bitplanes)
         self.start_grid = self.grid
         symmetry_str = element.get("symmetry")
         is_2d = self.start_grid.mz == 1
@@ -50,14 +68,14 @@ class Interpreter:
 
     def run(self, seed, steps, gif):
         self.random = random.Random(seed)
+        self.counter_random = CounterRandom(seed)
         self.grid = self.start_grid
         self.grid.clear()
         if self.origin:
             self.grid.state[self.grid.mx // 2 + (self.grid.my // 2) * self.grid.mx + (
                 self.grid.mz // 2) * self.grid.mx * self.grid.my] = 1
         self.changes.clear()
-        self.first.clear()
-        self.first.append(0)
+        self.step_start = 0
         self.root.reset()
         self.current = self.root
         self.gif = gif
@@ -71,7 +89,8 @@ class Interpreter:
             start2 = time.time()
             print(f"self.current.go() = {round(start2 - start1, 3)}s")
             self.counter += 1
-            self.first.append(len(self.changes))
+            self.changes.end_step()
+            self.step_start = len(self.changes)
         yield self.grid.state, self.grid.characters, self.grid.mx, self.grid.my, self.grid.mz
 
 
@@ -51,10 +51,12 @@ if __name__ == "__main__":
         mx = int(model.get("length", linear_size))
         my = int(model.get("width", linear_size))
         mz = int(model.get("height", 1 if dimension == 2 else linear_size))
+        numpy = bool(model.get("numpy", False))
+        bitplanes = bool(model.get("bitplanes", False))
         print(f"{name} > ")
         file_name = f"models/{name}.xml"
         try:
-            interpreter = Interpreter(file_name, mx, my, mz)
+            interpreter = Interpreter(file_name, mx, my, mz, numpy, bitplanes)
         except Exception as e:
             traceback.print_exc()
             break
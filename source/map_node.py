@@ -35,7 +35,7 @@ class MapNode(Branch):
         self.ny, self.dy = __class__.read_scale(scales[1])
         self.nz, self.dz = __class__.read_scale(scales[2])
         self.new_grid = Grid(element, grid.mx * self.nx // self.dx,
-                             grid.my * self.ny // self.dy, grid.mz * self.nz // self.dz)
+                             grid.my * self.ny // self.dy, grid.mz * self.nz // self.dz, grid.numpy, grid.bitplanes)
         if self.new_grid is None:
             return False
         if not super().load(element, parent_symmetry, self.new_grid):
@@ -95,7 +95,7 @@ class MapNode(Branch):
                         sz -= mz
                     input_wave = rule.input[dx + dy *
                                             rule.imx + dz * rule.imx * rule.imy]
-                    if (input_wave & (1 << state[sx + sy * mx + sz * mx * my])) == 0:
+                    if (input_wave & (1 << int(state[sx + sy * mx + sz * mx * my]))) == 0:
                         return False
         return True
 
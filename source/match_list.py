@@ -0,0 +1,138 @@
+from __future__ import annotations
+import numpy as np
+from numpy import ndarray
+
+
+class MatchList:
+    """
+    RuleNode的匹配列表，以结构数组的形式存储：rules[k]为第k个匹配的规则索引，cells[k]为匹配位置的一维索引x + y * mx + z * mx * my。
+    数组预先分配，容量不足时翻倍，count为真实长度。
+    """
+
+    def __init__(self, rule_count, mx, my, mz) -> None:
+        self.mx = mx
+        self.my = my
+        self.size = size = mx * my * mz
+        capacity = max(1, min(size, 1 << 12))
+        self.rules = np.zeros(capacity, dtype=np.int32)
+        self.cells = np.zeros(capacity, dtype=np.int32)
+
+        self.count = 0
+        """匹配的真实长度，所有当前匹配都位于该索引之前"""
+
+        self.width = (size + 7) >> 3
+        self.bits = bytearray(rule_count * self.width)
+        """
+        按位打包的成员标记，每个(规则, 单元格)只占1位：当且仅当(r, i)位于count之前时，bits[r * width + (i >> 3)]的第(i & 7)位为1，
+        用于O(1)判断匹配是否已在列表中。相比布尔矩阵内存减少到1/8。Python代码直接读写bytearray以避免numpy标量的开销。
+        """
+
+        self.mask = np.frombuffer(self.bits, dtype=np.uint8).reshape(
+            rule_count, self.width)
+        """bits的零拷贝numpy视图，形状为(规则数, width)，供向量化和编译的代码使用"""
+
+        self.slots: dict[int, int] = None
+        """
+        可选的反向索引，由index建立：键r * size + i到匹配(r, i)在数组中的位置k，只包含当前列表中的匹配，为None时不维护。
+        只有需要按位置查找匹配的节点（有sampler的OneNode）才建立，内存与匹配数量成正比，而不是与规则数乘网格大小成正比。
+        """
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, count):
+        """保证数组至少能容纳count个匹配"""
+        capacity = len(self.rules)
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity *= 2
+        self.rules = np.resize(self.rules, capacity)
+        self.cells = np.resize(self.cells, capacity)
+
+    def index(self):
+        """建立slots反向索引，此后find可用，增删匹配时同时维护索引"""
+        self.slots = dict(zip(self.keys().tolist(), range(self.count)))
+
+    def keys(self) -> ndarray:
+        """前count个匹配的键r * size + i"""
+        return self.rules[:self.count].astype(np.int64) * self.size + self.cells[:self.count]
+
+    def contains(self, r, i) -> bool:
+        return (self.bits[r * self.width + (i >> 3)] >> (i & 7)) & 1 == 1
+
+    def mark(self, r, i):
+        self.bits[r * self.width + (i >> 3)] |= 1 << (i & 7)
+
+    def unmark(self, r, i):
+        """只清除(r, i)的标记而不从数组中移除，用于随后整体丢弃列表的情况"""
+        self.bits[r * self.width + (i >> 3)] &= ~(1 << (i & 7)) & 0xFF
+
+    def find(self, r, i):
+        """返回匹配(r, i)在数组中的位置，不在列表中时返回-1，需要slots索引"""
+        return self.slots.get(r * self.size + i, -1)
+
+    def add(self, r, i):
+        self.mark(r, i)
+        self.reserve(self.count + 1)
+        if self.slots is not None:
+            self.slots[r * self.size + i] = self.count
+        self.rules[self.count] = r
+        self.cells[self.count] = i
+        self.count += 1
+
+    def add_all(self, rs: ndarray, cells: ndarray):
+        """add的批量版本，按给定顺序追加匹配"""
+        np.bitwise_or.at(self.mask, (rs, cells >> 3),
+                         np.left_shift(1, cells & 7).astype(np.uint8))
+        self.extend(rs, cells)
+
+    def extend(self, rs: ndarray, cells: ndarray):
+        """按给定顺序追加已在bits中标记过的匹配（如rescan_kernel找到的匹配），不再重复标记"""
+        n = len(rs)
+        self.reserve(self.count + n)
+        if self.slots is not None:
+            keys = rs.astype(np.int64) * self.size + cells
+            self.slots.update(
+                zip(keys.tolist(), range(self.count, self.count + n)))
+        self.rules[self.count:self.count + n] = rs
+        self.cells[self.count:self.count + n] = cells
+        self.count += n
+
+    def unmark_all(self, rs: ndarray, cells: ndarray):
+        """unmark的批量版本"""
+        np.bitwise_and.at(self.mask, (rs, cells >> 3),
+                          np.invert(np.left_shift(1, cells & 7).astype(np.uint8)))
+
+    def remove(self, k):
+        """移除第k个匹配，用最后一个匹配填补其位置，O(1)"""
+        r, i = int(self.rules[k]), int(self.cells[k])
+        self.unmark(r, i)
+        last = self.count - 1
+        if self.slots is not None:
+            del self.slots[r * self.size + i]
+            if k != last:
+                self.slots[int(self.rules[last]) * self.size +
+                           int(self.cells[last])] = k
+        self.rules[k] = self.rules[last]
+        self.cells[k] = self.cells[last]
+        self.count = last
+
+    def clear(self):
+        self.mask.fill(0)
+        if self.slots is not None:
+            self.slots.clear()
+        self.count = 0
+
+    def get(self, k):
+        """返回第k个匹配的(r, x, y, z)"""
+        i = int(self.cells[k])
+        return int(self.rules[k]), i % self.mx, (i // self.mx) % self.my, i // (self.mx * self.my)
+
+    def decode(self, order: ndarray = None):
+        """返回前count个匹配（或按order中的索引选取的匹配）的规则和坐标数组rs, xs, ys, zs"""
+        if order is None:
+            order = slice(0, self.count)
+        rs = self.rules[order]
+        cells = self.cells[order]
+        return rs, cells % self.mx, (cells // self.mx) % self.my, cells // (self.mx * self.my)
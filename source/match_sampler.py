@@ -0,0 +1,110 @@
+from __future__ import annotations
+import math
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from random import Random
+
+
+class MatchSampler:
+    """
+    OneNode在有势场时使用的加权采样结构。匹配以其在MatchList中的位置（槽位）标识，按启发值分桶存储，
+    插入、删除和移动槽位都是O(1)，每次采样的代价与不同启发值的数量成正比，而不是与匹配数量成正比。
+    启发值为None的匹配（新颜色在势场中不可达）只记录启发值，不参与采样。
+    """
+
+    def __init__(self) -> None:
+        self.heuristics: list[float] = []
+        """heuristics[slot]为槽位slot的匹配的启发值，长度即已加入的槽位数"""
+
+        self.buckets: dict[int, list[int]] = {}
+        """启发值到具有该启发值的槽位列表，空桶会被删除"""
+
+        self.positions: list[int] = []
+        """positions[slot]为槽位slot在其所在桶中的索引，启发值为None时为-1"""
+
+    def __len__(self):
+        return len(self.heuristics)
+
+    def clear(self):
+        self.heuristics.clear()
+        self.buckets.clear()
+        self.positions.clear()
+
+    def insert(self, slot, heuristic):
+        """加入槽位slot，slot为下一个槽位len(self)，或是之前被remove空出、由move重新填充的槽位"""
+        position = -1
+        if heuristic is not None:
+            bucket = self.buckets.get(heuristic)
+            if bucket is None:
+                bucket = self.buckets[heuristic] = []
+            position = len(bucket)
+            bucket.append(slot)
+        if slot == len(self.heuristics):
+            self.heuristics.append(heuristic)
+            self.positions.append(position)
+        else:
+            self.heuristics[slot] = heuristic
+            self.positions[slot] = position
+
+    def remove(self, slot):
+        """移除槽位slot，slot不是最后一个槽位时该槽位被空出，随后必须由move用最后一个槽位填充"""
+        heuristic = self.heuristics[slot]
+        k = self.positions[slot]
+        if slot == len(self.heuristics) - 1:
+            self.heuristics.pop()
+            self.positions.pop()
+        else:
+            self.heuristics[slot] = None
+            self.positions[slot] = -1
+        if heuristic is None:
+            return
+        bucket = self.buckets[heuristic]
+        last = bucket.pop()
+        if last != slot:
+            bucket[k] = last
+            self.positions[last] = k
+        elif not bucket:
+            del self.buckets[heuristic]
+
+    def update(self, slot, heuristic):
+        if self.heuristics[slot] != heuristic:
+            self.remove(slot)
+            self.insert(slot, heuristic)
+
+    def move(self, source, target):
+        """将source槽位的匹配移动到target槽位，对应MatchList.remove中用最后一个匹配填补空位"""
+        heuristic = self.heuristics[source]
+        self.remove(source)
+        self.insert(target, heuristic)
+
+    def first(self):
+        """返回槽位最小的匹配的启发值，即按列表顺序遇到的第一个启发值，没有时返回None"""
+        for heuristic in self.heuristics:
+            if heuristic is not None:
+                return heuristic
+        return None
+
+    def sample(self, random: Random, temperature):
+        """
+        随机选择一个槽位，没有可选的匹配时返回-1。
+        temperature > 0时，启发值为h的匹配被选中的概率正比于exp(-((h - first) // temperature))，与逐个比较u ** exp((h - first) // temperature)的分布相同；
+        否则在启发值最小的匹配中均匀选择。
+        """
+        if not self.buckets:
+            return -1
+        if temperature > 0:
+            first = self.first()
+            heuristics = list(self.buckets)
+            exponents = [(h - first) // temperature for h in heuristics]
+            least = min(exponents)
+            weights = [len(self.buckets[h]) * math.exp(least - e)
+                       for h, e in zip(heuristics, exponents)]
+            u = random.random() * sum(weights)
+            for heuristic, weight in zip(heuristics, weights):
+                u -= weight
+                if u < 0:
+                    break
+        else:
+            heuristic = min(self.buckets)
+        bucket = self.buckets[heuristic]
+        return bucket[random.randrange(len(bucket))]
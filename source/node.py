@@ -16,6 +16,9 @@ class Node:
 
     grid: Grid = None
 
+    id = 0
+    """节点在解释器中的编号，按创建顺序分配，用于区分CounterRandom中不同节点的随机数流"""
+
     @abstractmethod
     def load(self, element: _Element, symmetry: list[bool], grid: Grid) -> bool:
         pass
@@ -41,6 +41,8 @@ class NodeFactory:
         result: Node = node_map[localname]()
         result.ip = ip
         result.grid = grid
+        result.id = ip.node_count
+        ip.node_count += 1
         success = result.load(element, symmetry, grid)
         if not success:
             raise Exception(f"failed to load node \"{localname}\"")
@@ -3,7 +3,7 @@ import numpy as np
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from grid import Grid
-    from rule import Rule
+    from rule import RuleTable
     from numpy import ndarray
 
 
@@ -29,6 +29,7 @@ class Observation:
                 mask[i] = True
         # value对应颜色索引
         for i, value in enumerate(state):
+            value = int(value)
             obs = observations[value]
             mask[value] = True
             if obs is not None:
@@ -43,120 +44,135 @@ class Observation:
         return True
 
     @staticmethod
-    def compute_forward_potentials(potentials: ndarray, state: list[int], mx, my, mz, rules: list[Rule]):
+    def compute_forward_potentials(potentials: ndarray, state: list[int], mx, my, mz, table: RuleTable):
         """
         计算给定grid state的正向势。正向势potentials[c][x + y * mx + z * mx * my]，
         表示遵循rules到达颜色c所在位置(x, y, z)的状态所需重写次数的最小值。势为-1表示无法到达该状态。
         """
         potentials.fill(-1)
-        for i, v in enumerate(state):
-            potentials[v, i] = 0
-        Observation.compute_potentials(potentials, mx, my, mz, rules, False)
+        potentials[np.asarray(state, dtype=np.int64), np.arange(len(state))] = 0
+        Observation.compute_potentials(potentials, mx, my, mz, table, False)
 
     @staticmethod
-    def compute_backward_potentials(potentials: ndarray, future: list[int], mx, my, mz, rules: list[Rule]):
+    def compute_backward_potentials(potentials: ndarray, future: list[int], mx, my, mz, table: RuleTable):
+        future = np.asarray(future)
         for c in range(potentials.shape[0]):
-            potential = potentials[c]
-            for i, f in enumerate(future):
-                potential[i] = 0 if (f & (1 << c)) != 0 else -1
-        Observation.compute_potentials(potentials, mx, my, mz, rules, True)
+            potentials[c] = np.where((future >> c) & 1 == 1, 0, -1)
+        Observation.compute_potentials(potentials, mx, my, mz, table, True)
 
     @staticmethod
-    def compute_potentials(potentials: ndarray, mx, my, mz, rules: list[Rule], backwards=False):
-        queue = []
-        for (c, i), element in np.ndenumerate(potentials):
-            if element == 0:
-                queue.append(
-                    (c, i % mx, (i % (mx * my)) // mx, i // (mx * my)))
-        match_mask = np.full((len(rules), len(potentials[0])), False)
-        while queue:
-            value, x, y, z = queue.pop(0)
-            i = x + y * mx + z * mx * my
-            t = potentials[value, i]
-            for r, rule in enumerate(rules):
-                maskr = match_mask[r]
-                shifts = rule.oshifts[value] if backwards else rule.ishifts[value]
-                for shiftx, shifty, shiftz in shifts:
-                    sx = x - shiftx
-                    sy = y - shifty
-                    sz = z - shiftz
-                    if sx < 0 or sy < 0 or sz < 0 or (sx + rule.imx) > mx or (sy + rule.imy) > my or (sz + rule.imz) > mz:
-                        continue
-                    si = sx + sy * mx + sz * mx * my
-                    if not maskr[si] and Observation.forward_matches(rule, sx, sy, sz, potentials, t, mx, my, backwards):
-                        maskr[si] = True
-                        Observation.apply_forward(
-                            rule, sx, sy, sz, potentials, t, mx, my, backwards, queue)
-
-    @staticmethod
-    def forward_matches(rule: Rule, x, y, z, potentials: ndarray, t, mx, my, backwards):
-        dx = dy = dz = 0
-        a = rule.output if backwards else rule.input
-        for value in a:
-            if value != 255:
-                current = potentials[value, x + dx +
-                                     (y + dy) * mx + (z + dz) * mx * my]
-                if current > t or current == -1:
-                    return False
-            dx += 1
-            if dx == rule.imx:
-                dx = 0
-                dy += 1
-                if dy == rule.imy:
-                    dy = 0
-                    dz += 1
-        return True
+    def compute_potentials(potentials: ndarray, mx, my, mz, table: RuleTable, backwards=False):
+        """
+        从势为0的(颜色, 单元格)出发逐层扩展势场。第t层的所有(颜色, 单元格)一次性处理：找出包含它们的规则位置，
+        其中条件pattern的每个非通配符单元格的势都在[0, t]内且尚未应用过的位置被应用，结果pattern中势为-1的(颜色, 单元格)的势设为t + 1，构成下一层。
+        正向时条件pattern为table中的条件、结果pattern为写入，反向时相反。结果与逐个处理的广度优先搜索相同。
+        """
+        size = mx * my * mz
+        if backwards:
+            trigger_offsets, trigger_shifts = table.ocolor_offsets, table.ocolor_shifts
+            condition_offsets, condition_values, condition_deltas = table.write_offsets, table.write_values, table.write_deltas
+            result_offsets, result_values, result_deltas = table.condition_offsets, table.condition_values, table.condition_deltas
+        else:
+            trigger_offsets, trigger_shifts = table.color_offsets, table.color_shifts
+            condition_offsets, condition_values, condition_deltas = table.condition_offsets, table.condition_values, table.condition_deltas
+            result_offsets, result_values, result_deltas = table.write_offsets, table.write_values, table.write_deltas
+        # triggers[v]的每行为(r, shiftx, shifty, shiftz, imx, imy, imz)，表示颜色v可以出现在规则r的条件pattern中的偏移处
+        triggers = []
+        for v in range(len(trigger_offsets) - 1):
+            rows = trigger_shifts[trigger_offsets[v]:trigger_offsets[v + 1]].astype(np.int64)
+            triggers.append(np.concatenate(
+                (rows, table.shapes[rows[:, 0], :3]), axis=1))
+        # fired[r, si] == generation表示本次计算中规则r已在位置si应用过，换一个编号即可作废上次计算的标记
+        if table.fired is None:
+            table.fired = np.zeros((table.count, size), dtype=np.uint8)
+        table.generation += 1
+        if table.generation > 255:
+            table.fired.fill(0)
+            table.generation = 1
+        fired, generation = table.fired, table.generation
+        colors, cells = np.nonzero(potentials == 0)
+        t = 0
+        while len(cells) > 0:
+            # 包含本层(颜色, 单元格)的所有规则位置，键为r * size + si
+            keys = []
+            for v in np.unique(colors).tolist():
+                rows = triggers[v]
+                if len(rows) == 0:
+                    continue
+                i = cells[colors == v]
+                x, y, z = i % mx, (i // mx) % my, i // (mx * my)
+                sx = x[None, :] - rows[:, 1, None]
+                sy = y[None, :] - rows[:, 2, None]
+                sz = z[None, :] - rows[:, 3, None]
+                inside = (sx >= 0) & (sy >= 0) & (sz >= 0) & (sx + rows[:, 4, None] <= mx) & (
+                    sy + rows[:, 5, None] <= my) & (sz + rows[:, 6, None] <= mz)
+                rs = np.broadcast_to(rows[:, 0, None], inside.shape)
+                keys.append(rs[inside] * size +
+                            (sx + sy * mx + sz * mx * my)[inside])
+            if not keys:
+                break
+            keys = np.unique(np.concatenate(keys))
+            rs, sis = keys // size, keys % size
+            keep = fired[rs, sis] != generation
+            rs, sis = rs[keep], sis[keep]
+            bounds = np.searchsorted(rs, np.arange(table.count + 1))
+            next_colors = []
+            next_cells = []
+            for r in np.unique(rs).tolist():
+                si = sis[bounds[r]:bounds[r + 1]]
+                lo, hi = condition_offsets[r], condition_offsets[r + 1]
+                if lo < hi:
+                    values = potentials[condition_values[None, lo:hi],
+                                        si[:, None] + condition_deltas[None, lo:hi]]
+                    si = si[((values >= 0) & (values <= t)).all(axis=1)]
+                if len(si) == 0:
+                    continue
+                fired[r, si] = generation
+                lo, hi = result_offsets[r], result_offsets[r + 1]
+                targets = (si[:, None] + result_deltas[None, lo:hi]).ravel()
+                target_colors = np.broadcast_to(
+                    result_values[None, lo:hi], (len(si), hi - lo)).ravel()
+                empty = potentials[target_colors, targets] == -1
+                targets, target_colors = targets[empty], target_colors[empty]
+                potentials[target_colors, targets] = t + 1
+                next_colors.append(target_colors)
+                next_cells.append(targets)
+            if not next_cells:
+                break
+            # 多个规则位置可能写入同一(颜色, 单元格)
+            pairs = np.unique(np.concatenate(next_colors).astype(
+                np.int64) * size + np.concatenate(next_cells))
+            colors, cells = pairs // size, pairs % size
+            t += 1
 
     @staticmethod
-    def apply_forward(rule: Rule, x, y, z, potentials: ndarray, t, mx, my, backwards, q: list):
-        a = rule.binput if backwards else rule.output
-        for dz in range(rule.imz):
-            zdz = z + dz
-            for dy in range(rule.imy):
-                ydy = y + dy
-                for dx in range(rule.imx):
-                    xdx = x + dx
-                    idi = xdx + ydy * mx + zdz * mx * my
-                    di = dx + dy * rule.imx + dz * rule.imx * rule.imy
-                    o = a[di]
-                    if o != 255 and potentials[o, idi] == -1:
-                        potentials[o, idi] = t + 1
-                        q.append((o, xdx, ydy, zdz))
+    def satisfied(present: list[int], future: ndarray) -> ndarray:
+        """返回布尔数组，第i个元素表示单元格i的当前颜色是否满足未来状态的bitmask future[i]"""
+        present = np.asarray(present, dtype=np.int64)
+        return (future >> present) & 1 == 1
 
     @staticmethod
-    def is_goal_reached(present: list[int], future: list[int]):
-        for p, f in zip(present, future):
-            if ((1 << p) & f) == 0:
-                return False
-        return True
+    def is_goal_reached(present: list[int], future: ndarray):
+        return bool(Observation.satisfied(present, future).all())
 
     @staticmethod
-    def forward_pointwise(potentials: ndarray, future: list[int]):
+    def forward_pointwise(potentials: ndarray, future: ndarray):
         """使用给定的前向势计算与未来状态匹配的网格的最小分数，分数为-1表示无法到达目标"""
-        sum = 0
-        for i, f in enumerate(future):
-            min = 1000
-            argmin = -1
-            for c in range(potentials.shape[0]):
-                potential = potentials[c, i]
-                if (f & 1) == 1 and potential >= 0 and potential < min:
-                    min = potential
-                    argmin = c
-            if argmin < 0:
-                return -1
-            sum += min
-        return sum
+        colors = np.arange(potentials.shape[0])
+        allowed = (future[None, :] >> colors[:, None]) & 1 == 1
+        allowed &= (potentials >= 0) & (potentials < 1000)
+        if not allowed.any(axis=0).all():
+            return -1
+        return np.where(allowed, potentials, 1000).min(axis=0).sum().item()
 
     @staticmethod
     def backward_pointwise(potentials: ndarray, present: list[int]):
         """使用给定的后向势计算网格的分数，分数为-1表示无法到达目标"""
-        sum = 0
-        for i, v in enumerate(present):
-            potential = potentials[v, i]
-            if potential < 0:
-                return -1
-            sum += potential
-        return sum
+        present = np.asarray(present, dtype=np.int64)
+        values = potentials[present, np.arange(len(present))]
+        if (values < 0).any():
+            return -1
+        return values.sum().item()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,10 @@
 from __future__ import annotations
-import math
 import numpy as np
+from numpy import ndarray
 from rule_node import RuleNode
 from field import Field
-from observation import Observation
 from grid import Grid
+from match_sampler import MatchSampler
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from lxml.etree import _Element
@@ -17,21 +17,47 @@ class OneNode(RuleNode):
     def __init__(self) -> None:
         super().__init__()
 
+        self.sampler: MatchSampler = None
+        """有势场时按启发值对matches加权采样的结构，覆盖matches的前len(sampler)个槽位，没有势场时为None"""
+
+        self.footprints: list[list[tuple[int, int, int]]] = None
+        """footprints[r]为table.footprints中规则r的偏移解码后的(dx, dy, dz)，用于找出覆盖某个单元格的匹配，只有有sampler时才建立"""
+
+        self.applied = 0
+        """有sampler时Interpreter.changes中已检查过受影响匹配的更改数量，此后的更改由其他节点产生，需要在下次执行时检查"""
+
+        self.batch = 1
+        """
+        每次执行最多依次应用的匹配数量(XML中的batch属性)，大于1时解释器的每一步相当于该节点的batch步，分布与逐步执行相同，
+        但只在最后产生一次中间状态。有势场时忽略，因为势场可能需要在每一步之后重新计算。
+        只有父节点在两步之间直接再次执行该节点时分布才相同，因此markov中除第一个子节点以外的节点也忽略此属性。
+        """
+
     def load(self, element: _Element, parent_symmetry: list[bool], grid: Grid) -> bool:
         if not super().load(element, parent_symmetry, grid):
             return False
-        self.matches = []
+        if self.potentials is not None:
+            self.sampler = MatchSampler()
+            self.matches.index()
+            mx, my = grid.mx, grid.my
+            table = self.table
+            self.footprints = [[(d % mx, (d // mx) % my, d // (mx * my)) for d in table.footprints[table.footprint_offsets[r]:table.footprint_offsets[r + 1]].tolist()]
+                               for r in range(len(self.rules))]
+        else:
+            self.batch = int(element.get("batch", 1))
         return True
 
     def reset(self):
         super().reset()
         if self.match_count != 0:
-            self.match_mask.fill(False)
-            self.match_count = 0
+            self.matches.clear()
+        if self.sampler is not None:
+            self.sampler.clear()
 
     def apply(self, rule: Rule, x, y, z):
-        """在网格中的位置(x, y, z)处应用规则，该位置必须使得整个输出模式都在边界内。"""
+        """在网格中的位置(x, y, z)处应用规则，该位置必须使得整个输出模式都在边界内。返回发生变化的单元格的一维索引列表"""
         mx, my = self.grid.mx, self.grid.my
+        changed = []
         for dz in range(rule.omz):
             for dy in range(rule.omy):
                 for dx in range(rule.omx):
@@ -45,18 +71,34 @@ class OneNode(RuleNode):
                         old_value = self.grid.state[si]
                         if new_value != old_value:
                             self.grid.state[si] = new_value
-                            self.ip.changes.append((sx, sy, sz))
+                            self.ip.changes.append(si)
+                            changed.append(si)
+        if self.sampler is not None:
+            self.invalidate(changed)
+        return changed
 
     def go(self) -> bool:
         # print("OneNode go")
+        stale = self.counter == 0 or (self.observations is not None and not self.future_computed) or (
+            self.fields is not None and any(field is not None and field.recompute for field in self.fields))
         if not super().go():
             return False
-        self.last_matched_turn = self.ip.counter
+        if self.trajectory is None:
+            if self.sampler is not None:
+                if stale or self.last_matched_turn < 0:
+                    # 势场已重新计算或进行了全网格扫描，所有启发值都需要重新计算
+                    self.sampler.clear()
+                self.admit()
+                if self.last_matched_turn >= 0:
+                    self.invalidate(self.ip.changes.since(self.applied).tolist())
+                self.applied = len(self.ip.changes)
+        self.matched()
         if self.trajectory is not None:
             if self.counter >= len(self.trajectory):
                 return False
-            self.grid.state = self.trajectory[self.counter][:len(
+            self.grid.state[:] = self.trajectory[self.counter][:len(
                 self.grid.state)]
+            self.grid.invalidate_planes()
             self.counter += 1
             return True
         r, x, y, z = self.random_match(self.ip.random)
@@ -64,53 +106,102 @@ class OneNode(RuleNode):
             return False
         else:
             self.last[r] = True
-            self.apply(self.rules[r], x, y, z)
+            changed = self.apply(self.rules[r], x, y, z)
             self.counter += 1
+            for _ in range(self.batch - 1):
+                if self.steps > 0 and self.counter >= self.steps:
+                    break
+                # changes在同一步内去重，因此直接使用apply返回的单元格查找新的匹配
+                self.rescan(np.array(changed, dtype=np.int32))
+                r, x, y, z = self.random_match(self.ip.random)
+                if r < 0:
+                    break
+                self.last[r] = True
+                changed = self.apply(self.rules[r], x, y, z)
+                self.counter += 1
+            self.applied = len(self.ip.changes)
             return True
 
+    def heuristics(self, rs: ndarray, cells: ndarray) -> list:
+        """批量计算匹配(rs[m], cells[m])的启发值，在势场中不可达的匹配为None"""
+        values, valid = Field.delta_pointwise_all(
+            self.grid.state, self.table, rs, cells, self.fields, self.potentials)
+        return [h if ok else None for h, ok in zip(values.tolist(), valid.tolist())]
+
+    def admit(self):
+        """验证matches中尚未加入sampler的匹配，移除无效的匹配，其余的按启发值加入sampler"""
+        start = k = len(self.sampler)
+        while k < self.match_count:
+            r, x, y, z = self.matches.get(k)
+            if self.grid.matches(self.rules[r], x, y, z):
+                k += 1
+            else:
+                self.matches.remove(k)
+        heuristics = self.heuristics(
+            self.matches.rules[start:k], self.matches.cells[start:k])
+        for k, heuristic in enumerate(heuristics, start):
+            self.sampler.insert(k, heuristic)
+
+    def discard(self, k):
+        """移除已加入sampler的第k个匹配，保持matches与sampler的槽位一致"""
+        last = self.match_count - 1
+        self.sampler.remove(k)
+        if k != last:
+            self.sampler.move(last, k)
+        self.matches.remove(k)
+
+    def invalidate(self, cells: list[int]):
+        """
+        立即移除覆盖了给定单元格且已不再成立的匹配，并更新仍然成立的匹配的启发值，只用于有sampler的节点。
+        apply之后调用，使sampler中的权重是准确的，采样时基本不需要拒绝过时的匹配。
+        没有sampler时不做这项工作，过时的匹配在random_match抽到时才被验证和移除，每个被抽到的过时匹配只需一次Grid.matches。
+        """
+        mx, my, mz = self.grid.mx, self.grid.my, self.grid.mz
+        candidates = []
+        for i in cells:
+            x, y, z = i % mx, (i // mx) % my, i // (mx * my)
+            for r, rule in enumerate(self.rules):
+                for dx, dy, dz in self.footprints[r]:
+                    sx, sy, sz = x - dx, y - dy, z - dz
+                    if sx < 0 or sy < 0 or sz < 0 or (sx + rule.imx) > mx or (sy + rule.imy) > my or (sz + rule.imz) > mz:
+                        continue
+                    si = sx + sy * mx + sz * mx * my
+                    if self.matches.find(r, si) >= 0:
+                        candidates.append((r, si))
+        if not candidates:
+            return
+        # 处理过程中网格不变，可以先一次性计算所有候选匹配的启发值
+        rs, sis = np.array(candidates, dtype=np.int64).T
+        heuristics = self.heuristics(rs, sis)
+        for n, (r, si) in enumerate(candidates):
+            k = self.matches.find(r, si)
+            if k < 0:
+                # 已被之前的候选项移除
+                continue
+            if not self.grid.matches(self.rules[r], si % mx, (si // mx) % my, si // (mx * my)):
+                self.discard(k)
+            else:
+                self.sampler.update(k, heuristics[n])
+
     def random_match(self, random: Random):
         if self.potentials is not None:
-            if self.observations is not None and Observation.is_goal_reached(self.grid.state, self.future):
+            if self.observations is not None and self.goal_reached():
                 self.future_computed = False
                 return (-1, -1, -1, -1)
-            max = -1000.0
-            argmax = -1
-            first_heuristic = 0.0
-            first_heuristic_computed = False
-            k = 0
-            while k < self.match_count:
-                r, x, y, z = self.matches[k]
-                i = x + y * self.grid.mx + z * self.grid.mx * self.grid.my
-                if not self.grid.matches(self.rules[r], x, y, z):
-                    self.match_mask[r, i] = False
-                    self.matches[k] = self.matches[self.match_count - 1]
-                    self.match_count -= 1
-                    k -= 1
-                else:
-                    heuristic = Field.delta_pointwise(
-                        self.grid.state, self.rules[r], x, y, z, self.fields, self.potentials, self.grid.mx, self.grid.my)
-                    if heuristic is None:
-                        k += 1
-                        continue
-                    if not first_heuristic_computed:
-                        first_heuristic = heuristic
-                        first_heuristic_computed = True
-                    u = random.random()
-                    key = u ** math.exp((heuristic - first_heuristic) //
-                                        self.temperature) if self.temperature > 0 else 0.001 * u - heuristic
-                    if key > max:
-                        max = key
-                        argmax = k
-                k += 1
-            return self.matches[argmax] if argmax >= 0 else (-1, -1, -1, -1)
+            while True:
+                k = self.sampler.sample(random, self.temperature)
+                if k < 0:
+                    return (-1, -1, -1, -1)
+                r, x, y, z = self.matches.get(k)
+                if self.grid.matches(self.rules[r], x, y, z):
+                    return (r, x, y, z)
+                # 未记录在changes中的网格更改（如卷积节点）也可能使匹配失效
+                self.discard(k)
         else:
             while self.match_count > 0:
                 match_index = random.randrange(0, self.match_count)
-                r, x, y, z = self.matches[match_index]
-                i = x + y * self.grid.mx + z * self.grid.mx * self.grid.my
-                self.match_mask[r, i] = False
-                self.matches[match_index] = self.matches[self.match_count - 1]
-                self.match_count -= 1
+                r, x, y, z = self.matches.get(match_index)
+                self.matches.remove(match_index)
                 if self.grid.matches(self.rules[r], x, y, z):
                     return (r, x, y, z)
             return (-1, -1, -1, -1)
@@ -31,7 +31,8 @@ class OverlapNode(WFCNode):
                 f"unknown symmetry {symmetry_str} at line {element.sourceline}")
             return False
         periodic_input = bool(element.get("periodicInput", True))
-        self.new_grid = Grid(element, grid.mx, grid.my, grid.mz)
+        self.new_grid = Grid(element, grid.mx, grid.my,
+                             grid.mz, grid.numpy, grid.bitplanes)
         if self.new_grid is None:
             return False
         self.periodic = True
@@ -141,6 +142,7 @@ class OverlapNode(WFCNode):
                     argmax = c
                     max = value
             self.new_grid.state[i] = argmax
+        self.new_grid.invalidate_planes()
 
     def agrees(self, p1, p2, dx, dy):
         xmin = 0 if dx < 0 else dx
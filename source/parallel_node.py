@@ -1,4 +1,5 @@
 from __future__ import annotations
+import numpy as np
 from numpy import ndarray
 from rule_node import RuleNode
 from typing import TYPE_CHECKING
@@ -17,17 +18,29 @@ class ParallelNode(RuleNode):
     def __init__(self) -> None:
         super().__init__()
 
+        self.new_state = None
+        """非numpy模式下的第二个缓冲区，被改变的单元格的新颜色先写入这里，全部匹配处理完后再复制回state"""
+
+        self.pending: list[tuple[ndarray, ndarray]] = []
+        """numpy模式下本次执行待写入的(单元格, 新颜色)数组，按匹配顺序排列，执行结束时一次性写入state"""
+
     def load(self, element: _Element, parent_symmetry: list[bool], grid: Grid) -> bool:
         # print("ParallelNode load")
         if not super().load(element, parent_symmetry, grid):
             return False
-        self.new_state = [0] * len(self.grid.state)
+        if not grid.numpy:
+            self.new_state = [0] * len(self.grid.state)
         return True
 
-    def add(self, r, x, y, z, maskr: ndarray):
-        rule = self.rules[r]
-        if self.ip.random.random() > rule.p:
+    def add(self, r, x, y, z):
+        mx, my = self.grid.mx, self.grid.my
+        if self.ip.counter_random.random1(self.ip.counter, self.id, r, x + y * mx + z * mx * my) > self.rules[r].p:
             return
+        self.write(r, x, y, z)
+
+    def write(self, r, x, y, z):
+        """将已被选中的匹配写入new_state，非numpy模式使用"""
+        rule = self.rules[r]
         self.last[r] = True
         mx, my = self.grid.mx, self.grid.my
         omx, omy, omz = rule.omx, rule.omy, rule.omz
@@ -38,15 +51,56 @@ class ParallelNode(RuleNode):
                     idi = x + dx + (y + dy) * mx + (z + dz) * mx * my
                     if new_value != 255 and new_value != self.grid.state[idi]:
                         self.new_state[idi] = new_value
-                        self.ip.changes.append((x + dx, y + dy, z + dz))
+                        self.ip.changes.append(idi)
         self.match_count += 1
 
+    def add_all(self, rs: ndarray, xs: ndarray, ys: ndarray, zs: ndarray):
+        # 每个匹配的随机数只由(步数, 节点, 规则, 单元格)决定，可以一次全部抽取，结果与逐个添加相同
+        mx, my = self.grid.mx, self.grid.my
+        u = self.ip.counter_random.random(
+            self.ip.counter, self.id, rs, xs + ys * mx + zs * mx * my)
+        chosen = u <= self.table.p[rs]
+        if not self.grid.numpy:
+            for r, x, y, z in zip(rs[chosen].tolist(), xs[chosen].tolist(), ys[chosen].tolist(), zs[chosen].tolist()):
+                self.write(r, x, y, z)
+            return
+        rs = rs[chosen]
+        if len(rs) == 0:
+            return
+        for r in np.unique(rs).tolist():
+            self.last[r] = True
+        self.match_count += len(rs)
+        owners, cells, values = self.expand(
+            rs, xs[chosen] + ys[chosen] * mx + zs[chosen] * mx * my)
+        order = np.argsort(owners, kind="stable")
+        cells, values = cells[order], values[order]
+        keep = values != self.grid.state[cells]
+        self.pending.append((cells[keep], values[keep]))
+
     def go(self) -> bool:
         if not super().go():
             return False
-        for n in range(self.ip.first[self.ip.counter], len(self.ip.changes)):
-            x, y, z = self.ip.changes[n]
-            i = x + y * self.grid.mx + z * self.grid.mx * self.grid.my
-            self.grid.state[i] = self.new_state[i]
+        if self.grid.numpy:
+            self.flush()
+        else:
+            for n in range(self.ip.step_start, len(self.ip.changes)):
+                i = self.ip.changes[n]
+                self.grid.state[i] = self.new_state[i]
         self.counter += 1
         return self.match_count > 0
+
+    def flush(self):
+        """
+        将pending中的写入一次性应用到state。所有匹配都基于执行前的state，因此不需要第二个缓冲区：
+        同一单元格的多次写入以最后一次为准，changes按每个单元格第一次写入的顺序记录，与逐个add的结果相同。
+        """
+        if not self.pending:
+            return
+        cells = np.concatenate([c for c, _ in self.pending])
+        values = np.concatenate([v for _, v in self.pending])
+        self.pending.clear()
+        _, first = np.unique(cells, return_index=True)
+        self.ip.changes.extend(cells[np.sort(first)])
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last
+        self.grid.state[cells[last]] = values[last]
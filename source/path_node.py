@@ -52,7 +52,7 @@ class PathNode(Node):
                     i = x + y * mx + z * mx * my
                     # TODO 可以删除？
                     generations[i] = -1
-                    s = self.grid.state[i]
+                    s = int(self.grid.state[i])
                     # 不等于0说明颜色相同或者是通配符。&左右两个数字只有最高位是1，其他位是0，所以最高位相同时，&运算结果不等于0。
                     # 而两个数字都是通过1左移索引位得到的，最高位相同说明颜色索引一定相同或者是通配符。
                     # 因为通配符所有位都是1，另一个数字最高位是1，对应位也满足“都是1”这个条件
@@ -66,7 +66,7 @@ class PathNode(Node):
 
         def push(t, x, y, z):
             i = x + y * mx + z * mx * my
-            v = self.grid.state[i]
+            v = int(self.grid.state[i])
             if generations[i] == -1 and ((self.substrate & 1 << v) != 0 or (self.start & 1 << v) != 0):
                 if (self.substrate & 1 << v) != 0:
                     frontier.append((t, x, y, z))
@@ -109,7 +109,7 @@ class PathNode(Node):
         # 不等于0说明没有到达结束位置
         while generations[penx + peny * mx + penz * mx * my] != 0:
             self.grid.state[penx + peny * mx + penz * mx * my] = self.value
-            self.ip.changes.append((penx, peny, penz))
+            self.ip.changes.append(penx + peny * mx + penz * mx * my)
             dirx, diry, dirz = self.direction(
                 penx, peny, penz, dirx, diry, dirz, generations, local_random)
             penx += dirx
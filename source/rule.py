@@ -1,4 +1,5 @@
 from __future__ import annotations
+import numpy as np
 from graphic import Graphic
 from helper import Helper
 from symmetry_helper import SymmetryHelper
@@ -261,6 +262,115 @@ class Rule:
         return 255
 
 
+class RuleTable:
+    """
+    将一个节点的所有规则（包括对称变体）打包为连续的numpy数组，在加载时构建一次，匹配、重写、势场和启发值计算需要的打包规则数据都从这里读取。
+    变长数据使用CSR布局：规则r的数据位于data[offsets[r]:offsets[r + 1]]。
+    pattern中单元格的偏移按网格尺寸展开为相对于匹配位置的一维偏移dx + dy * mx + dz * mx * my，按pattern中的顺序排列。
+    """
+
+    def __init__(self, rules: list[Rule], grid: Grid) -> None:
+        c, mx, my = grid.c, grid.mx, grid.my
+        self.count = len(rules)
+        """规则数量"""
+
+        self.c = c
+        """颜色数量"""
+
+        self.shapes = np.array([(rule.imx, rule.imy, rule.imz, rule.omx, rule.omy, rule.omz)
+                               for rule in rules], dtype=np.int32).reshape(-1, 6)
+        """每条规则的(imx, imy, imz, omx, omy, omz)"""
+
+        self.p = np.array([rule.p for rule in rules], dtype=np.float64)
+
+        self.input_offsets = __class__.offsets(
+            [len(rule.input) for rule in rules])
+        self.inputs = np.array([w for rule in rules for w in rule.input],
+                               dtype=np.int64 if c < 64 else object)
+        """所有规则的输入bitmask，按input_offsets划分，颜色数不少于64时无法放进int64，退化为Python整数"""
+
+        conditions = []
+        writes = []
+        footprints = []
+        for rule in rules:
+            same_shape = (rule.imx, rule.imy, rule.imz) == (
+                rule.omx, rule.omy, rule.omz)
+            write = [(delta, value, not same_shape or (rule.input[k] >> value) & 1 == 0)
+                     for k, (delta, value) in enumerate(zip(__class__.deltas(rule.omx, rule.omy, rule.omz, mx, my), rule.output))
+                     if value != 255]
+            condition = [(delta, value) for delta, value in zip(__class__.deltas(rule.imx, rule.imy, rule.imz, mx, my), rule.binput)
+                         if value != 255]
+            conditions.append(condition)
+            writes.append(write)
+            footprints.append(
+                sorted(set(delta for delta, _ in condition) | set(delta for delta, _, _ in write)))
+
+        self.condition_offsets = __class__.offsets(
+            [len(condition) for condition in conditions])
+        self.condition_deltas = np.array(
+            [delta for condition in conditions for delta, _ in condition], dtype=np.int64)
+        self.condition_values = np.array(
+            [value for condition in conditions for _, value in condition], dtype=np.int64)
+        """输入不是通配符的单元格的偏移和binput颜色，按condition_offsets划分。输入允许多种颜色时binput是其中编号最小的颜色"""
+
+        self.write_offsets = __class__.offsets(
+            [len(write) for write in writes])
+        self.write_deltas = np.array(
+            [delta for write in writes for delta, _, _ in write], dtype=np.int64)
+        self.write_values = np.array(
+            [value for write in writes for _, value, _ in write], dtype=np.uint8)
+        """输出中非通配符单元格的偏移和新颜色，按write_offsets划分"""
+        self.write_changes = np.array(
+            [change for write in writes for _, _, change in write], dtype=np.bool_)
+        """write_changes[k]表示第k个写入的新颜色不在输入允许的颜色中，即应用匹配时该单元格一定会改变，启发值只考虑这些写入"""
+
+        self.footprint_offsets = __class__.offsets(
+            [len(footprint) for footprint in footprints])
+        self.footprints = np.array(
+            [delta for footprint in footprints for delta in footprint], dtype=np.int64)
+        """规则读取或写入的单元格（条件和写入的并集）的偏移，从小到大排列，按footprint_offsets划分"""
+
+        self.color_offsets, self.color_shifts = __class__.index_by_color(
+            [rule.ishifts for rule in rules], c)
+        """
+        按颜色索引的(规则, 偏移)对：颜色v的所有(r, shiftx, shifty, shiftz)位于color_shifts[color_offsets[v]:color_offsets[v + 1]]，
+        先按r再按偏移排序，重新扫描时只需访问与单元格新颜色相关的部分
+        """
+
+        self.ocolor_offsets, self.ocolor_shifts = __class__.index_by_color(
+            [getattr(rule, "oshifts", None) for rule in rules], c)
+        """与color_shifts相同，但来自输出pattern的oshifts(输出为通配符的位置属于所有颜色)，输入输出尺寸不同的规则没有对应的项"""
+
+        self.fired = None
+        """Observation.compute_potentials使用的(count, 网格大小)的uint8数组，第一次计算势场时分配，此后在各次计算间复用"""
+
+        self.generation = 0
+        """当前势场计算的编号，fired[r, si] == generation表示本次计算中规则r已在位置si应用过，编号用完（超过255）时清零fired重新开始"""
+
+    @staticmethod
+    def offsets(lengths: list[int]):
+        result = np.zeros(len(lengths) + 1, dtype=np.int32)
+        np.cumsum(lengths, out=result[1:])
+        return result
+
+    @staticmethod
+    def deltas(sx, sy, sz, mx, my):
+        """尺寸为(sx, sy, sz)的pattern中每个单元格按顺序展开后相对于pattern位置的一维偏移"""
+        return [dx + dy * mx + dz * mx * my for dz in range(sz) for dy in range(sy) for dx in range(sx)]
+
+    @staticmethod
+    def index_by_color(shifts_list: list[list[list[tuple[int, int, int]]]], c):
+        """将每条规则按颜色划分的偏移列表按颜色重新分组为(color_offsets, color_shifts)，偏移列表为None的规则被跳过"""
+        lengths = []
+        data = []
+        for v in range(c):
+            items = [(r, *shift) for r, shifts in enumerate(shifts_list) if shifts is not None
+                     for shift in shifts[v]]
+            lengths.append(len(items))
+            data.extend(items)
+        return __class__.offsets(lengths), np.array(data, dtype=np.int32).reshape(-1, 4)
+
+
 if __name__ == "__main__":
     a = [1, 2]
     print(str(a), a)
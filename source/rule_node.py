@@ -4,12 +4,13 @@ import numpy as np
 from lxml import etree
 from numpy import ndarray
 from node import Node
-from rule import Rule
+from rule import Rule, RuleTable
 from field import Field
 from search import Search
 from observation import Observation
 from symmetry_helper import SymmetryHelper
-from grid import Grid
+from grid import Grid, rescan_kernel
+from match_list import MatchList
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from lxml.etree import _Element
@@ -17,6 +18,12 @@ if TYPE_CHECKING:
 
 class RuleNode(Node):
 
+    backward_cache_size = 8
+    """backward_cache的最大项数"""
+
+    kernel_threshold = 2
+    """rescan使用编译内核所需的最少变化单元格数，变化较少时调用内核的固定开销超过Python循环本身"""
+
     def __init__(self) -> None:
         self.rules: list[Rule] = []
         self.last = []
@@ -30,45 +37,63 @@ class RuleNode(Node):
         """是否已计算由该节点的observations确定的轨迹或向后电位。如果没有observations，则该标志无关紧要。"""
 
         self.last_matched_turn = 0
-        """上次匹配的轮次，用于跟踪应重新扫描网格中的更改以查找匹配项。如果自上次全网格扫描以来该节点已重置，则 last_matched_turn 为 -1"""
+        """
+        上次匹配的轮次。如果自上次全网格扫描以来该节点已重置，则 last_matched_turn 为 -1。
+        需要重新扫描的更改从该节点在Interpreter.changes中登记的游标开始，游标落在已丢弃的记录中时改为全网格扫描。
+        """
 
         self.counter = 0
         """此节点已执行的次数(重置会刷新)"""
 
-        self.future = []
+        self.future: ndarray = None
         """
         如果节点存在observe，那么这个数组表示由这些观测结果确定的未来目标。
         每个元素都是颜色的bitmask，当网格中的每个单元格匹配响应的bitmask时，目标就达到了。
+        颜色数不少于64时bitmask无法放进int64，数组退化为Python整数。
         """
 
+        self.satisfied: ndarray = None
+        """satisfied[i]表示单元格i的颜色是否满足future[i]，在计算future时建立，之后根据changes增量更新"""
+
+        self.unsatisfied = 0
+        """satisfied中False的数量"""
+
+        self.goal_cursor = 0
+        """satisfied已考虑到的changes绝对索引"""
+
+        self.goal_unlogged = 0
+        """建立或重建satisfied时的grid.unlogged，不相等时说明网格有未记录在changes中的更改，需要重新检查整个网格"""
+
         self.steps = 0
         """此节点可执行的最大次数(非累计，重置会刷新计数)，如果为0，则无限制"""
 
         self.temperature = 0.0
         self.potentials = None
 
-        self.matches = []
-        """
-        (r, x, y, z)元组列表，其中规则r在网格中的位置(x, y, z)处匹配。该列表包含所有当前匹配项，但也可能包含一些过时的匹配项。
-        为了避免过度分配和释放，列表永远不会被缩短，match_count字段是列表的真实长度。
-        所有当前匹配都发生在该索引之前，除非这是OneNode，否则不会出现过时的匹配。
-        """
-
-        self.match_count = 0
+        self.backward_cache: dict[bytes, ndarray] = {}
         """
-        matches的真实长度，实际列表长度可能大于match_count，所有当前匹配都发生在matches列表中的该索引之前。
-        如果这是一个OneNode，那么该列表还可能在此索引之前包含一些过时的匹配项，因此该字段只是当前匹配项数量的最大值。
+        future到其反向势的缓存。反向势只取决于future、网格尺寸和规则，因此在重置、搜索重试和多次运行之间保留，
+        最多保存backward_cache_size项，超出时丢弃最早的一项
         """
 
-        self.match_mask = None
+        self.matches: MatchList = None
         """
-        将每个rule映射到一个二维numpy布尔数组，与matches列表中的元素对应。
-        当且仅当(r, x, y, z)位于列表中match_count索引之前时，match_mask[r][x + y * mx + z * mx * my]为True。
+        匹配列表，其中规则r在网格中的一维位置i处匹配。
+        为了避免过度分配和释放，数组永远不会被缩短，match_count是列表的真实长度，所有当前匹配都发生在该索引之前。
+        有势场的OneNode在网格变化时立即移除失效的匹配；没有势场的OneNode可能包含一些过时的匹配，在抽到时才被移除；
+        其他节点每次执行后都会整体丢弃列表，因此不会出现过时的匹配。
+        matches.mask[r, i]为True当且仅当(r, i)位于列表中match_count索引之前。
         """
 
         self.trajectory = None
         """通过搜索找到的状态列表。当执行该节点时，轨迹中预先计算的状态将被复制到网格中，而不是像平常一样应用重写规则"""
 
+        self.table: RuleTable = None
+        """rules打包后的连续数组，在加载时构建"""
+
+        self.shifts_by_color: list[list[tuple[int, Rule, int, int, int]]] = None
+        """table.color_shifts按颜色拆分的Python列表，附带规则对象，供非编译模式的增量重新扫描逐项遍历"""
+
     def load(self, element: _Element, parent_symmetry: list[bool], grid: Grid) -> bool:
         # print("RuleNode load")
         symmetry_str = element.get("symmetry")
@@ -99,8 +124,11 @@ class RuleNode(Node):
         self.last = [False] * len(self.rules)
         self.steps = int(element.get("steps", 0))
         self.temperature = float(element.get("temperature", 0.0))
-        self.match_mask = np.full(
-            (len(self.rules), len(self.grid.state)), False)
+        self.matches = MatchList(len(self.rules), grid.mx, grid.my, grid.mz)
+        self.table = table = RuleTable(self.rules, grid)
+        self.shifts_by_color = [[(r, self.rules[r], shiftx, shifty, shiftz) for r, shiftx, shifty, shiftz in
+                                 table.color_shifts[table.color_offsets[v]:table.color_offsets[v + 1]].tolist()]
+                                for v in range(grid.c)]
         color_count = grid.c
         state_length = len(grid.state)
         field_elements: list[_Element] = element.findall("field")
@@ -130,24 +158,144 @@ class RuleNode(Node):
                     element.get("depthCoefficient", 0.5))
             else:
                 self.potentials = np.zeros((color_count, state_length))
-            self.future = [0] * state_length
+            self.future = np.zeros(
+                state_length, dtype=np.int64 if color_count < 64 else object)
         return True
 
+    def backward_potentials(self, future: list[int]) -> ndarray:
+        """返回future对应的反向势，相同的future只计算一次。返回的数组为缓存本身，调用者不能修改"""
+        key = np.array(future, dtype=np.int64).tobytes() if self.grid.c < 64 else tuple(future)
+        potentials = self.backward_cache.get(key)
+        if potentials is None:
+            potentials = np.zeros((self.grid.c, len(future)))
+            Observation.compute_backward_potentials(
+                potentials, future, self.grid.mx, self.grid.my, self.grid.mz, self.table)
+            if len(self.backward_cache) >= self.backward_cache_size:
+                del self.backward_cache[next(iter(self.backward_cache))]
+            self.backward_cache[key] = potentials
+        return potentials
+
+    def recheck_goal(self):
+        """根据整个网格重建satisfied和unsatisfied"""
+        self.satisfied = Observation.satisfied(self.grid.state, self.future)
+        self.unsatisfied = len(self.satisfied) - \
+            int(np.count_nonzero(self.satisfied))
+        self.goal_cursor = len(self.ip.changes)
+        self.goal_unlogged = self.grid.unlogged
+
+    def goal_reached(self):
+        """
+        网格是否已达到future。只重新检查上次检查以来changes中的单元格，代价与变化的单元格数量成正比；
+        网格有未记录在changes中的更改（卷积、轨迹回放等）或所需的记录已被丢弃时，重新检查整个网格。
+        """
+        changes = self.ip.changes
+        if self.goal_unlogged == self.grid.unlogged and changes.available(self.goal_cursor):
+            cells = np.unique(changes.since(self.goal_cursor))
+            state = self.grid.state
+            present = state[cells] if self.grid.numpy else [state[i] for i in cells.tolist()]
+            now = Observation.satisfied(present, self.future[cells])
+            self.unsatisfied += int(np.count_nonzero(self.satisfied[cells])) - int(np.count_nonzero(now))
+            self.satisfied[cells] = now
+            self.goal_cursor = len(changes)
+        else:
+            self.recheck_goal()
+        return self.unsatisfied == 0
+
+    @property
+    def match_count(self):
+        """
+        matches的真实长度，所有当前匹配都发生在matches列表中的该索引之前。
+        对于没有势场的OneNode，该列表还可能在此索引之前包含一些过时的匹配项，因此该字段只是当前匹配项数量的最大值。
+        """
+        return self.matches.count
+
+    @match_count.setter
+    def match_count(self, value):
+        self.matches.count = value
+
     def reset(self):
         self.last_matched_turn = -1
+        self.ip.changes.release(self)
         self.counter = 0
         self.future_computed = False
         self.last = [False] * len(self.last)
 
-    def add(self, r, x, y, z, maskr: ndarray):
-        """当grid与rule匹配时，会调用此方法，各个rule之间的mask相互独立"""
-        maskr[x + y * self.grid.mx + z * self.grid.mx * self.grid.my] = True
-        match = (r, x, y, z)
-        if self.match_count < len(self.matches):
-            self.matches[self.match_count] = match
-        else:
-            self.matches.append(match)
-        self.match_count += 1
+    def matched(self):
+        """记录本轮已完成匹配，下次执行时从本轮的第一次更改开始重新扫描"""
+        self.last_matched_turn = self.ip.counter
+        self.ip.changes.watch(self, self.ip.step_start)
+
+    def add(self, r, x, y, z):
+        """当grid与rule匹配时，会调用此方法"""
+        self.matches.add(r, x + y * self.grid.mx + z *
+                         self.grid.mx * self.grid.my)
+
+    def add_all(self, rs: ndarray, xs: ndarray, ys: ndarray, zs: ndarray):
+        """add的批量版本，按给定顺序添加一组匹配(rs[k], xs[k], ys[k], zs[k])"""
+        mx, my = self.grid.mx, self.grid.my
+        self.matches.add_all(rs, xs + ys * mx + zs * mx * my)
+
+    def expand(self, rs: ndarray, cells: ndarray):
+        """
+        将一组匹配(rs[m], cells[m])展开为写入列表owners, cells, values：第k个写入由第owners[k]个匹配把单元格cells[k]改为values[k]。
+        写入按规则分组，同一匹配的写入相邻且按输出pattern的顺序排列。
+        """
+        bases = cells.astype(np.int64)
+        order = np.argsort(rs, kind="stable")
+        bounds = np.searchsorted(rs[order], np.arange(len(self.rules) + 1))
+        table = self.table
+        owners, targets, values = [], [], []
+        for r in range(len(self.rules)):
+            group = order[bounds[r]:bounds[r + 1]]
+            lo, hi = table.write_offsets[r], table.write_offsets[r + 1]
+            if len(group) == 0 or lo == hi:
+                continue
+            deltas, new_values = table.write_deltas[lo:hi], table.write_values[lo:hi]
+            owners.append(np.repeat(group, len(deltas)))
+            targets.append((bases[group, None] + deltas[None, :]).ravel())
+            values.append(np.tile(new_values, len(group)))
+        if not owners:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        return np.concatenate(owners), np.concatenate(targets), np.concatenate(values)
+
+    @staticmethod
+    def scan_order(rule: Rule, match_map: ndarray):
+        """
+        返回匹配图中所有匹配位置的坐标数组xs, ys, zs，顺序与逐格扫描一致：
+        先按步长为输入pattern尺寸的采样格排序，再按采样格在输入pattern中的位置排序。
+        每个匹配窗口中恰好包含一个采样格，因此每个匹配只出现一次。
+        """
+        zs, ys, xs = np.nonzero(match_map)
+        lx = xs // rule.imx * rule.imx + rule.imx - 1
+        ly = ys // rule.imy * rule.imy + rule.imy - 1
+        lz = zs // rule.imz * rule.imz + rule.imz - 1
+        order = np.lexsort((lx - xs, ly - ys, lz - zs, lx, ly, lz))
+        return xs[order], ys[order], zs[order]
+
+    def rescan(self, changes: ndarray):
+        """在发生变化的单元格（一维索引的int32数组）周围查找新的匹配并加入matches"""
+        mx, my, mz = self.grid.mx, self.grid.my, self.grid.mz
+        if self.grid.compiled() and len(changes) >= __class__.kernel_threshold:
+            table = self.table
+            found = rescan_kernel(self.grid.state, changes, mx, my, mz, table.shapes, table.input_offsets,
+                                  table.inputs, table.color_offsets, table.color_shifts, self.matches.mask)
+            if len(found) > 0:
+                # 内核已在mask中标记了新匹配
+                self.matches.extend(found[:, 0], found[:, 1])
+            return
+        for i in changes.tolist():
+            x, y, z = i % mx, (i // mx) % my, i // (mx * my)
+            for r, rule, shiftx, shifty, shiftz in self.shifts_by_color[self.grid.state[i]]:
+                sx = x - shiftx
+                sy = y - shifty
+                sz = z - shiftz
+                # 边界情况
+                if sx < 0 or sy < 0 or sz < 0 or (sx + rule.imx) > mx or (sy + rule.imy) > my or (sz + rule.imz) > mz:
+                    continue
+                si = sx + sy * mx + sz * mx * my
+                # 避免重复添加相同位置
+                if not self.matches.contains(r, si) and self.grid.matches(rule, sx, sy, sz):
+                    self.add(r, sx, sy, sz)
 
     def go(self) -> bool:
         # print("RuleNode go")
@@ -159,61 +307,51 @@ class RuleNode(Node):
             if not Observation.compute_future_set_present(self.future, self.grid.state, self.observations):
                 return False
             else:
+                self.grid.invalidate_planes()
                 self.future_computed = True
+                self.recheck_goal()
                 if self.search:
                     self.trajectory = None
                     tries = 1 if self.limit < 0 else 20
                     k = 0
                     while k < tries and self.trajectory is None:
                         self.trajectory = Search.run(
-                            self.grid.state, self.future, self.rules, self.grid.mx, self.grid.my, self.grid.mz, self, self.limit, self.depth_coefficient, self.ip.random.random())
+                            self.grid.state, self.future, self.rules, self.grid.mx, self.grid.my, self.grid.mz, self.grid.c, self, self.limit, self.depth_coefficient, self.ip.random.random())
                         k += 1
                     if self.trajectory is None:
                         print("search returned none")
                 else:
-                    Observation.compute_backward_potentials(
-                        self.potentials, self.future, mx, my, mz, self.rules)
+                    self.potentials[:] = self.backward_potentials(self.future)
+        start = self.ip.changes.cursor(self)
+        if self.last_matched_turn >= 0 and not self.ip.changes.available(start):
+            # 所需的更改记录已被丢弃，只能重新扫描整个网格
+            self.matches.clear()
+            self.last_matched_turn = -1
+        # 上次执行以来发生变化的单元格，重新扫描整个网格时为None
+        changes = None
         if self.last_matched_turn >= 0:
-            for n in range(self.ip.first[self.last_matched_turn], len(self.ip.changes)):
-                x, y, z = self.ip.changes[n]
-                value = self.grid.state[x + y * mx + z * mx * my]
-                for r, rule in enumerate(self.rules):
-                    maskr = self.match_mask[r]
-                    shifts = rule.ishifts[value]
-                    for shiftx, shifty, shiftz in shifts:
-                        sx = x - shiftx
-                        sy = y - shifty
-                        sz = z - shiftz
-                        # 边界情况
-                        if sx < 0 or sy < 0 or sz < 0 or (sx + rule.imx) > mx or (sy + rule.imy) > my or (sz + rule.imz) > mz:
-                            continue
-                        si = sx + sy * mx + sz * mx * my
-                        # maskr避免重复添加相同位置
-                        if not maskr[si] and self.grid.matches(rule, sx, sy, sz):
-                            self.add(r, sx, sy, sz, maskr)
+            changes = self.ip.changes.since(start)
+            self.rescan(changes)
         else:
             self.match_count = 0
+            if self.grid.bitplanes:
+                self.grid.sync_planes(self.ip.changes)
+            else:
+                state = self.grid.view()
             for r, rule in enumerate(self.rules):
-                maskr = self.match_mask[r]
-                for z in range(rule.imz - 1, mz, rule.imz):
-                    for y in range(rule.imy - 1, my, rule.imy):
-                        for x in range(rule.imx - 1, mx, rule.imx):
-                            value = self.grid.state[x + y * mx + z * mx * my]
-                            shifts = rule.ishifts[value]
-                            for shiftx, shifty, shiftz in shifts:
-                                sx = x - shiftx
-                                sy = y - shifty
-                                sz = z - shiftz
-                                # 边界情况
-                                if sx < 0 or sy < 0 or sz < 0 or (sx + rule.imx) > mx or (sy + rule.imy) > my or (sz + rule.imz) > mz:
-                                    continue
-                                if self.grid.matches(rule, sx, sy, sz):
-                                    self.add(r, sx, sy, sz, maskr)
+                match_map = self.grid.plane_match_map(
+                    rule) if self.grid.bitplanes else self.grid.match_map(rule, state)
+                xs, ys, zs = self.scan_order(rule, match_map)
+                self.add_all(np.full(len(xs), r), xs, ys, zs)
         if self.fields is not None:
             any_success = any_computation = False
             for c, field in enumerate(self.fields):
                 if field is not None and (self.counter == 0 or field.recompute):
-                    success = field.compute(self.potentials[c], self.grid)
+                    if changes is None:
+                        success = field.compute(self.potentials[c], self.grid)
+                    else:
+                        # 上次执行时已计算过势场，只需修复发生变化的单元格附近
+                        success = field.update(self.potentials[c], self.grid, changes)
                     if not success and field.essential:
                         return False
                     any_success |= success
@@ -1,11 +1,12 @@
 from __future__ import annotations
 import random
 import numpy as np
-from queue import PriorityQueue
+import heapq
 from helper import Helper
 from observation import Observation
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
+    from numpy import ndarray
     from rule import Rule
     from random import Random
 
@@ -13,21 +14,22 @@ if TYPE_CHECKING:
 class Search:
 
     @staticmethod
-    def run(present: list[int], future: list[int], rules: list[Rule], mx, my, mz, c, node, limit, depth_coefficient, seed) -> list[Board]:
+    def run(present: list[int], future: list[int], rules: list[Rule], mx, my, mz, c, node, limit, depth_coefficient, seed) -> list[list[int]]:
         """
         尝试找到网格状态的轨迹，从当前状态开始，到匹配未来状态结束。轨迹中的每个状态都是将给定规则之一应用于前一个状态的结果。
         轨迹为网格状态列表，如果未找到轨迹则为None，当前状态不包含在轨迹中。
+        搜索过程中的状态以每个单元格一个字节的bytes存储，visited直接以bytes为键，每个状态只保存一份。
+        状态被扩展时才由父状态的匹配集得到其匹配集，只在被改变的单元格周围更新；待扩展的状态不保存匹配集。后向估计也只根据被改变的单元格增量计算。
         """
         from all_node import AllNode
         is_all_node = isinstance(node, AllNode)
-        bpotentials = np.full((c, len(present)), -1)
+        present = bytes(bytearray(int(v) for v in present))
+        bpotentials = node.backward_potentials(future)
         fpotentials = np.full((c, len(present)), -1)
-        Observation.compute_backward_potentials(
-            bpotentials, future, mx, my, mz, rules)
         root_backward_estimate = Observation.backward_pointwise(
-            bpotentials, present)
+            bpotentials, np.frombuffer(present, dtype=np.uint8))
         Observation.compute_forward_potentials(
-            fpotentials, present, mx, my, mz, rules)
+            fpotentials, np.frombuffer(present, dtype=np.uint8), mx, my, mz, node.table)
         root_forward_estimate = Observation.forward_pointwise(
             fpotentials, future)
         if root_backward_estimate < 0 or root_forward_estimate < 0:
@@ -40,63 +42,73 @@ class Search:
         root_board = Board(
             present, -1, 0, root_backward_estimate, root_forward_estimate)
         database = [root_board]
-        visited = {tuple(present): 0}
-        frontier = PriorityQueue()
+        visited = {present: 0}
+        frontier = []
         local_random = random.Random(seed)
-        frontier.put((root_board.rank(local_random, depth_coefficient), 0))
+        heapq.heappush(
+            frontier, (root_board.rank(local_random, depth_coefficient), 0))
         record = root_backward_estimate + root_forward_estimate
         while frontier and (limit < 0 or len(database) < limit):
-            _, parent_index = frontier.get()
+            _, parent_index = heapq.heappop(frontier)
             parent_board = database[parent_index]
-            children = Search.all_child_states(parent_board.state, mx, my, rules) if is_all_node else Search.one_child_states(
-                parent_board.state, mx, my, rules)
+            parent_matches = Search.board_matches(
+                parent_board, database, rules, mx, my)
+            parent_array = np.frombuffer(parent_board.state, dtype=np.uint8)
+            children = Search.all_child_states(parent_board.state, parent_matches, mx, my, rules) if is_all_node else Search.one_child_states(
+                parent_board.state, parent_matches, mx, my, rules)
             for child_state in children:
-                if child_state in visited:
-                    child_index = visited[child_state]
+                child_index = visited.get(child_state)
+                if child_index is not None:
                     old_board = database[child_index]
                     if (parent_board.depth + 1) < old_board.depth:
                         old_board.depth = parent_board.depth + 1
                         old_board.parent_index = parent_index
                         if old_board.backward_estimate >= 0 and old_board.forward_estimate >= 0:
-                            frontier.put(
-                                (old_board.rank(local_random, depth_coefficient), child_index))
+                            heapq.heappush(
+                                frontier, (old_board.rank(local_random, depth_coefficient), child_index))
                 else:
-                    child_backward_estimate = Observation.backward_pointwise(
-                        bpotentials, child_state)
+                    child_array = np.frombuffer(child_state, dtype=np.uint8)
+                    changed = np.flatnonzero(child_array != parent_array)
+                    # 父状态的后向估计非负，只需加上被改变的单元格的势的变化
+                    new_potentials = bpotentials[child_array[changed], changed]
+                    if (new_potentials < 0).any():
+                        continue
+                    child_backward_estimate = parent_board.backward_estimate + (
+                        new_potentials - bpotentials[parent_array[changed], changed]).sum().item()
                     Observation.compute_forward_potentials(
-                        fpotentials, child_state, mx, my, mz, rules)
+                        fpotentials, child_array, mx, my, mz, node.table)
                     child_forward_estimate = Observation.forward_pointwise(
                         fpotentials, future)
-                    if child_backward_estimate < 0 or child_forward_estimate < 0:
+                    if child_forward_estimate < 0:
                         continue
                     child_board = Board(child_state, parent_index, parent_board.depth +
                                         1, child_backward_estimate, child_forward_estimate)
                     database.append(child_board)
                     child_index = len(database) - 1
-                    visited[(child_board.state)] = child_index
+                    visited[child_state] = child_index
                     if child_board.forward_estimate == 0:
                         print(
                             f"found a trajectory of length {parent_board.depth + 1}, visited {len(visited)} states")
                         trajectory = Board.trajectory(child_index, database)
                         trajectory.reverse()
-                        return [b.state for b in trajectory]
+                        return [list(b.state) for b in trajectory]
                     else:
                         if limit < 0 and (child_backward_estimate + child_forward_estimate) <= record:
                             record = child_backward_estimate + child_forward_estimate
                             print(
                                 f"found a state of record estimate {record} = {child_backward_estimate} + {child_forward_estimate}")
-                            frontier.put(
-                                (child_board.rank(local_random, depth_coefficient), child_index))
+                        heapq.heappush(
+                            frontier, (child_board.rank(local_random, depth_coefficient), child_index))
         return None
 
     @staticmethod
-    def matches(rule: Rule, x, y, state: list[int], mx, my):
+    def matches(rule: Rule, x, y, state: bytes, mx, my):
         """判断此规则在给定网格状态中的位置(x, y)处是否匹配"""
         if (x + rule.imx) > mx or (y + rule.imy) > my:
             return False
         dx = dy = 0
         for v in rule.input:
-            if (v & (1 << state[x + dx + (y + dy) * mx])) == 0:
+            if (v & (1 << int(state[x + dx + (y + dy) * mx]))) == 0:
                 return False
             dx += 1
             if dx == rule.imx:
@@ -105,9 +117,9 @@ class Search:
         return True
 
     @staticmethod
-    def applied(rule: Rule, x, y, state: list[int], mx):
+    def applied(rule: Rule, x, y, state: bytes, mx):
         """将规则应用于位置(x, y)，返回一个新状态"""
-        result = state[:]
+        result = bytearray(state)
         for dz in range(rule.omz):
             for dy in range(rule.omy):
                 for dx in range(rule.omx):
@@ -115,12 +127,12 @@ class Search:
                                             rule.omx + dz * rule.omx * rule.omy]
                     if new_value != 255:
                         result[x + dx + (y + dy) * mx] = new_value
-        return result
+        return bytes(result)
 
     @staticmethod
     def is_inside(p: tuple[int, int], rule: Rule, x, y):
         """判断此(x, y)元组是否位于给定规则的输入模式内的给定位置"""
-        return x < p[0] and p[0] < (x + rule.imx) and y < p[1] and p[1] < (y + rule.imy)
+        return x <= p[0] and p[0] < (x + rule.imx) and y <= p[1] and p[1] < (y + rule.imy)
 
     @staticmethod
     def overlap(rule0: Rule, x0, y0, rule1: Rule, x1, y1):
@@ -132,54 +144,102 @@ class Search:
         return False
 
     @staticmethod
-    def one_child_states(state: list[int], mx, my, rules: list[Rule]):
-        """对one节点执行给定规则，返回可以从该状态一步到达的状态列表。"""
-        result = []
-        for rule in rules:
-            for y in range(my):
-                for x in range(mx):
-                    if Search.matches(rule, x, y, state, mx, my):
-                        result.append(Search.applied(rule, x, y, state, mx))
-        return result
+    def match_all(state: bytes, rules: list[Rule], mx, my) -> ndarray:
+        """扫描整个状态，返回所有匹配的键r * len(state) + x + y * mx组成的有序数组，即先按规则再按位置排序"""
+        size = len(state)
+        keys = [r * size + x + y * mx for r, rule in enumerate(rules)
+                for y in range(my) for x in range(mx) if Search.matches(rule, x, y, state, mx, my)]
+        return np.array(keys, dtype=np.int64)
 
     @staticmethod
-    def all_child_states(state: list[int], mx, my, rules: list[Rule]):
-        """对all节点执行给定规则，返回可以从该状态一步到达的状态列表。"""
+    def board_matches(board: Board, database: list[Board], rules: list[Rule], mx, my) -> ndarray:
+        """
+        返回要扩展的状态的匹配集并保存在board中。父状态已被扩展，因此保存着匹配集，只需根据两者不同的单元格增量更新；
+        没有父状态时扫描整个状态
+        """
+        if board.matches is None:
+            if board.parent_index < 0:
+                board.matches = Search.match_all(board.state, rules, mx, my)
+            else:
+                parent = database[board.parent_index]
+                changed = np.flatnonzero(np.frombuffer(board.state, dtype=np.uint8) != np.frombuffer(
+                    parent.state, dtype=np.uint8))
+                board.matches = Search.rematch(
+                    Search.board_matches(parent, database, rules, mx, my), board.state, changed, rules, mx, my)
+        return board.matches
+
+    @staticmethod
+    def rematch(matches: ndarray, state: bytes, changed: ndarray, rules: list[Rule], mx, my) -> ndarray:
+        """
+        由父状态的匹配matches（match_all格式）得到子状态state的匹配：只重新检查覆盖了被改变的单元格changed的规则位置，
+        其余匹配保持不变
+        """
+        size = len(state)
+        affected = set()
+        found = []
+        for r, rule in enumerate(rules):
+            for i in changed.tolist():
+                x, y = i % mx, i // mx
+                for sy in range(max(y - rule.imy + 1, 0), min(y, my - rule.imy) + 1):
+                    for sx in range(max(x - rule.imx + 1, 0), min(x, mx - rule.imx) + 1):
+                        key = r * size + sx + sy * mx
+                        if key not in affected:
+                            affected.add(key)
+                            if Search.matches(rule, sx, sy, state, mx, my):
+                                found.append(key)
+        if not affected:
+            return matches
+        kept = matches[~np.isin(matches, np.fromiter(affected, dtype=np.int64))]
+        return np.union1d(kept, np.array(found, dtype=np.int64))
+
+    @staticmethod
+    def one_child_states(state: bytes, matches: ndarray, mx, my, rules: list[Rule]):
+        """对one节点执行给定规则，返回可以从该状态一步到达的状态列表，matches为该状态的匹配（match_all格式）。"""
+        size = len(state)
+        return [Search.applied(rules[key // size], key % size % mx, key % size // mx, state, mx)
+                for key in matches.tolist()]
+
+    @staticmethod
+    def all_child_states(state: bytes, matches: ndarray, mx, my, rules: list[Rule]):
+        """对all节点执行给定规则，返回可以从该状态一步到达的状态列表，matches为该状态的匹配（match_all格式）。"""
+        size = len(state)
+        rs, cells = matches // size, matches % size
+        # 与逐格扫描相同，先按位置再按规则排列
+        order = np.lexsort((rs, cells))
         tiles = []
-        amounts = [0] * len(state)
-        for i in range(len(state)):
+        amounts = [0] * size
+        for r, i in zip(rs[order].tolist(), cells[order].tolist()):
+            rule = rules[r]
+            tiles.append((rule, i))
             x = i % mx
             y = i // mx
-            for rule in rules:
-                if Search.matches(rule, x, y, state, mx, my):
-                    tiles.append((rule, i))
-                    for dy in range(rule.imy):
-                        for dx in range(rule.imx):
-                            amounts[x + dx + (y + dy) * mx] += 1
-        mask = np.full(len(tiles), True)
+            for dy in range(rule.imy):
+                for dx in range(rule.imx):
+                    amounts[x + dx + (y + dy) * mx] += 1
+        mask = [True] * len(tiles)
         solution = []
         result = []
         Search.enumerate(result, solution, tiles, amounts, mask, state, mx)
         return result
 
     @staticmethod
-    def enumerate(children: list[int], solution: list[tuple[Rule, int]], tiles: list[tuple[Rule, int]], amounts: list[int], mask: list[bool], state: list[int], mx):
+    def enumerate(children: list[bytes], solution: list[tuple[Rule, int]], tiles: list[tuple[Rule, int]], amounts: list[int], mask: list[bool], state: bytes, mx):
         """通过递归回溯搜索，查找并应用all节点的规则的所有最大非重叠匹配集。"""
         index = Helper.max_positive_index(amounts)
         x = index % mx
         y = index // mx
         if index < 0:
-            children.append(Search.apply(solution, mx))
+            children.append(Search.apply(state, solution, mx))
             return
         cover = []
-        for l, rule, i in tiles:
+        for l, (rule, i) in enumerate(tiles):
             if mask[l] and Search.is_inside((x, y), rule, i % mx, i // mx):
                 cover.append((rule, i))
         for rule, i in cover:
             solution.append((rule, i))
             intersecting = []
-            for l, rule1, i1 in tiles:
-                if Search.overlap(rule, i % mx, i // mx, rule1, i1 % mx, i1 // mx):
+            for l, (rule1, i1) in enumerate(tiles):
+                if mask[l] and Search.overlap(rule, i % mx, i // mx, rule1, i1 % mx, i1 // mx):
                     intersecting.append(l)
             for l in intersecting:
                 Search.hide(l, False, tiles, amounts, mask, mx)
@@ -198,18 +258,18 @@ class Search:
         incr = 1 if unhide else -1
         for dy in range(rule.imy):
             for dx in range(rule.imx):
-                amounts[x + dx + (y + dy) * mx] = incr
+                amounts[x + dx + (y + dy) * mx] += incr
 
     @staticmethod
-    def apply(state: list[int], solution: list[tuple[Rule, int]], mx):
+    def apply(state: bytes, solution: list[tuple[Rule, int]], mx):
         """将一组不重叠的规则应用于此网格状态，返回新的网格状态。"""
-        result = state[:]
+        result = bytearray(state)
         for rule, i in solution:
             Search.apply_rule(rule, i % mx, i // mx, result, mx)
-        return result
+        return bytes(result)
 
     @staticmethod
-    def apply_rule(rule: Rule, x, y, state: list[int], mx):
+    def apply_rule(rule: Rule, x, y, state: bytearray, mx):
         for dy in range(rule.omy):
             for dx in range(rule.omx):
                 c = rule.output[dx + dy * rule.omx]
@@ -218,14 +278,21 @@ class Search:
 
 
 class Board:
+    """搜索中访问过的状态，state为每个单元格一个字节的网格状态。搜索可能创建数十万个Board，因此使用__slots__"""
 
-    def __init__(self, state: list[int], parent_index, depth, backward_estimate, forward_estimate) -> None:
+    __slots__ = ("state", "parent_index", "depth",
+                 "backward_estimate", "forward_estimate", "matches")
+
+    def __init__(self, state: bytes, parent_index, depth, backward_estimate, forward_estimate) -> None:
         self.state = state
         self.parent_index = parent_index
         self.depth = depth
         self.backward_estimate = backward_estimate
         self.forward_estimate = forward_estimate
 
+        self.matches: ndarray = None
+        """该状态的匹配（Search.match_all格式），在状态第一次被扩展时由Search.board_matches计算，之后保留供子状态使用，待扩展的状态为None"""
+
     def rank(self, random: Random, depth_coefficient):
         result = 1000 - self.depth if depth_coefficient < 0 else self.forward_estimate + \
             self.backward_estimate + 2 * depth_coefficient * self.depth
@@ -243,9 +310,9 @@ class Board:
 
 
 if __name__ == "__main__":
-    q = PriorityQueue()
-    q.put((0.1, "a"))
-    q.put((0.0, "b"))
-    q.put((0.2, "c"))
-    _, a = q.get()
+    q = []
+    heapq.heappush(q, (0.1, "a"))
+    heapq.heappush(q, (0.0, "b"))
+    heapq.heappush(q, (0.2, "c"))
+    _, a = heapq.heappop(q)
     print(a)
@@ -46,7 +46,7 @@ class TileNode(WFCNode):
                 f"tiles should be cubes for the full symmetry option: {self.S} != {self.SZ}")
             return False
         self.new_grid = Grid(element, (self.S - self.overlap) * grid.mx + self.overlap, (self.S - self.overlap)
-                             * grid.my + self.overlap, (self.SZ - self.overlap) * grid.mz + self.overlap)
+                             * grid.my + self.overlap, (self.SZ - self.overlap) * grid.mz + self.overlap, grid.numpy, grid.bitplanes)
         if self.new_grid is None:
             return False
 
@@ -305,6 +305,7 @@ class TileNode(WFCNode):
                                 sz = z * (self.SZ - self.overlap) + dz
                                 self.new_grid.state[sx + sy * self.new_grid.mx +
                                                     sz * self.new_grid.mx * self.new_grid.my] = argmax
+        self.new_grid.invalidate_planes()
         print(f"total time = {time.time() - start2}")
 
 
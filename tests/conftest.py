@@ -0,0 +1,7 @@
+import os
+import sys
+
+# source中的模块使用平铺的导入方式，并按相对于仓库根目录的路径读取模型和资源
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "source"))
+os.chdir(ROOT)
@@ -0,0 +1,74 @@
+import numpy as np
+from change_log import ChangeLog
+
+
+def test_append_deduplicates_within_a_step():
+    changes = ChangeLog()
+    for i in (3, 5, 3, 7, 5):
+        changes.append(i)
+    assert len(changes) == 3
+    assert changes.since(0).tolist() == [3, 5, 7]
+    changes.end_step()
+    changes.append(3)
+    assert changes.since(3).tolist() == [3]
+
+
+def test_extend_matches_append():
+    a, b = ChangeLog(), ChangeLog()
+    for batch in ([1, 2, 3], [2, 4], [4, 5, 1]):
+        a.extend(np.array(batch, dtype=np.int32))
+        for i in batch:
+            b.append(i)
+    assert a.since(0).tolist() == b.since(0).tolist() == [1, 2, 3, 4, 5]
+
+
+def test_cursor_of_unwatched_owner_is_unavailable():
+    changes = ChangeLog()
+    owner = object()
+    assert changes.cursor(owner) == -1
+    assert not changes.available(changes.cursor(owner))
+    changes.watch(owner, 0)
+    assert changes.cursor(owner) == 0
+    changes.release(owner)
+    assert changes.cursor(owner) == -1
+
+
+def test_slowest_cursor_keeps_its_records():
+    changes = ChangeLog()
+    slow, fast = object(), object()
+    changes.watch(slow, 0)
+    for step in range(10):
+        changes.watch(fast, len(changes))
+        changes.append(step)
+        changes.end_step()
+    assert changes.available(changes.cursor(slow))
+    assert changes.since(changes.cursor(slow)).tolist() == list(range(10))
+    assert changes.since(changes.cursor(fast)).tolist() == [9]
+
+
+def test_records_before_every_cursor_are_dropped():
+    changes = ChangeLog()
+    owner = object()
+    for step in range(10):
+        changes.append(step)
+        changes.watch(owner, len(changes))
+        changes.end_step()
+    # 绝对索引不受丢弃影响
+    assert len(changes) == 10
+    assert changes.offset > 0
+    assert not changes.available(0)
+    assert changes.since(changes.cursor(owner)).tolist() == []
+    changes.append(42)
+    assert changes[changes.cursor(owner)] == 42
+
+
+def test_capacity_bounds_records_kept_for_a_stalled_cursor():
+    changes = ChangeLog(capacity=4)
+    owner = object()
+    changes.watch(owner, 0)
+    for step in range(20):
+        changes.append(step)
+        changes.end_step()
+    assert not changes.available(changes.cursor(owner))
+    assert len(changes.data) <= 8
+    assert changes.since(len(changes) - 4).tolist() == [16, 17, 18, 19]
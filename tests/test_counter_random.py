@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import counter_random
+from counter_random import CounterRandom
+
+# Random123中philox4x32-10的已知答案：(计数器, 密钥, 输出的前两个字)
+KNOWN_ANSWERS = [
+    ((0, 0, 0, 0), (0, 0), (0x6627e8d5, 0xe169c58d)),
+    ((0xffffffff, 0xffffffff, 0xffffffff, 0xffffffff),
+     (0xffffffff, 0xffffffff), (0x408f276d, 0x41c83b0e)),
+    ((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344),
+     (0xa4093822, 0x299f31d0), (0xd16cfe09, 0x94fdcceb)),
+]
+
+
+def expected(words):
+    """CounterRandom由输出的前两个字组成53位的浮点数"""
+    return ((words[0] >> 5) * 67108864 + (words[1] >> 6)) / 9007199254740992.0
+
+
+@pytest.mark.parametrize("counter, key, words", KNOWN_ANSWERS)
+def test_random1_known_answers(counter, key, words):
+    # 计数器的四个字依次为(单元格, 步数, 节点, 通道)
+    cell, step, node, lane = counter
+    generator = CounterRandom(key[0] | key[1] << 32)
+    assert generator.random1(step, node, lane, cell) == expected(words)
+
+
+@pytest.mark.parametrize("compiled", [True, False])
+@pytest.mark.parametrize("counter, key, words", KNOWN_ANSWERS)
+def test_random_known_answers(monkeypatch, compiled, counter, key, words):
+    if compiled and not counter_random.HAS_NUMBA:
+        pytest.skip("numba is not available")
+    monkeypatch.setattr(counter_random, "HAS_NUMBA", compiled)
+    cell, step, node, lane = counter
+    generator = CounterRandom(key[0] | key[1] << 32)
+    values = generator.random(step, node, lane, np.array([cell, cell]))
+    assert values.tolist() == [expected(words)] * 2
+
+
+@pytest.mark.parametrize("compiled", [True, False])
+def test_random_matches_random1(monkeypatch, compiled):
+    if compiled and not counter_random.HAS_NUMBA:
+        pytest.skip("numba is not available")
+    monkeypatch.setattr(counter_random, "HAS_NUMBA", compiled)
+    generator = CounterRandom(12345)
+    cells = np.arange(50)
+    lanes = cells % 3
+    values = generator.random(7, 2, lanes, cells)
+    assert values.tolist() == [generator.random1(7, 2, lane, cell)
+                               for lane, cell in zip(lanes.tolist(), cells.tolist())]
+    assert ((values >= 0) & (values < 1)).all()
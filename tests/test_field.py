@@ -0,0 +1,65 @@
+import random
+import numpy as np
+import pytest
+from lxml import etree
+from grid import Grid
+from field import Field
+
+
+def setup(mx, my, mz, numpy, seed):
+    grid = Grid(etree.fromstring('<one values="BWR"/>'), mx, my, mz, numpy)
+    field = Field(etree.fromstring('<field for="R" to="W" on="B"/>'), grid)
+    rng = random.Random(seed)
+    # 少量零点和墙，使大部分单元格可达且距离较长
+    for i in range(len(grid.state)):
+        u = rng.random()
+        grid.state[i] = 1 if u < 0.01 else 2 if u < 0.25 else 0
+    return grid, field, rng
+
+
+def fresh(field: Field, grid: Grid):
+    potential = np.zeros(len(grid.state), dtype=np.int64)
+    success = field.compute(potential, grid)
+    return potential, success
+
+
+@pytest.mark.parametrize("numpy", [False, True])
+@pytest.mark.parametrize("shape", [(64, 64, 1), (16, 16, 4)])
+def test_update_matches_compute(numpy, shape):
+    grid, field, rng = setup(*shape, numpy, 1)
+    potential, _ = fresh(field, grid)
+    for _ in range(40):
+        changes = []
+        for _ in range(rng.randint(1, 3)):
+            i = rng.randrange(len(grid.state))
+            grid.state[i] = rng.choice((0, 0, 1, 2))
+            changes.append(i)
+        success = field.update(potential, grid, np.array(changes + changes[:1]))
+        expected, expected_success = fresh(field, grid)
+        assert (potential == expected).all()
+        assert success == expected_success
+
+
+@pytest.mark.parametrize("numpy", [False, True])
+def test_update_after_unlogged_write_matches_compute(numpy):
+    grid, field, rng = setup(48, 48, 1, numpy, 2)
+    potential, _ = fresh(field, grid)
+    # 不记录到changes的写入（如卷积节点），update只收到空的变化列表
+    for i in rng.sample(range(len(grid.state)), 200):
+        grid.state[i] = rng.choice((0, 1, 2))
+    grid.invalidate_planes()
+    field.update(potential, grid, np.array([], dtype=np.int32))
+    expected, _ = fresh(field, grid)
+    assert (potential == expected).all()
+
+
+def test_update_reports_missing_zero():
+    grid, field, _ = setup(8, 8, 1, False, 3)
+    grid.state[0] = 1
+    potential, success = fresh(field, grid)
+    assert success
+    zeros = [i for i, v in enumerate(grid.state) if v == 1]
+    for i in zeros:
+        grid.state[i] = 0
+    assert not field.update(potential, grid, np.array(zeros, dtype=np.int32))
+    assert (potential == -1).all()
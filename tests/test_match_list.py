@@ -0,0 +1,95 @@
+import numpy as np
+from match_list import MatchList
+
+
+def entries(matches: MatchList):
+    return list(zip(matches.rules[:matches.count].tolist(), matches.cells[:matches.count].tolist()))
+
+
+def check_index(matches: MatchList):
+    """slots只包含当前匹配，且与数组中的位置一致"""
+    assert len(matches.slots) == matches.count
+    for k, (r, i) in enumerate(entries(matches)):
+        assert matches.find(r, i) == k
+
+
+def test_add_marks_and_grows():
+    matches = MatchList(2, 3, 2, 1)
+    for k in range(20):
+        matches.add(k % 2, k % 6)
+    assert len(matches) == 20
+    assert matches.contains(1, 5) and not matches.contains(1, 4)
+    assert matches.get(5) == (1, 2, 1, 0)
+
+
+def test_add_all_matches_add():
+    a, b = MatchList(3, 4, 4, 1), MatchList(3, 4, 4, 1)
+    rs = np.array([0, 2, 1, 2], dtype=np.int32)
+    cells = np.array([15, 0, 7, 9], dtype=np.int32)
+    a.add_all(rs, cells)
+    for r, i in zip(rs.tolist(), cells.tolist()):
+        b.add(r, i)
+    assert entries(a) == entries(b)
+    assert bytes(a.bits) == bytes(b.bits)
+
+
+def test_extend_does_not_mark():
+    matches = MatchList(1, 4, 1, 1)
+    matches.extend(np.array([0], dtype=np.int32), np.array([2], dtype=np.int32))
+    assert entries(matches) == [(0, 2)]
+    assert not matches.contains(0, 2)
+
+
+def test_remove_swaps_in_last_match():
+    matches = MatchList(2, 4, 1, 1)
+    matches.index()
+    for r, i in ((0, 0), (1, 1), (0, 2), (1, 3)):
+        matches.add(r, i)
+    matches.remove(1)
+    assert entries(matches) == [(0, 0), (1, 3), (0, 2)]
+    assert not matches.contains(1, 1)
+    assert matches.find(1, 1) == -1
+    check_index(matches)
+    matches.remove(2)
+    assert entries(matches) == [(0, 0), (1, 3)]
+    check_index(matches)
+
+
+def test_index_follows_batches_and_clear():
+    matches = MatchList(2, 5, 5, 1)
+    matches.add(1, 24)
+    matches.index()
+    check_index(matches)
+    matches.add_all(np.array([0, 1], dtype=np.int32), np.array([3, 4], dtype=np.int32))
+    matches.extend(np.array([0], dtype=np.int32), np.array([9], dtype=np.int32))
+    check_index(matches)
+    matches.clear()
+    assert len(matches) == 0 and matches.slots == {}
+    assert not matches.mask.any()
+    assert matches.find(1, 24) == -1
+
+
+def test_unindexed_list_has_no_slots():
+    matches = MatchList(1, 2, 2, 1)
+    matches.add(0, 3)
+    matches.remove(0)
+    assert matches.slots is None and len(matches) == 0
+
+
+def test_unmark_all_keeps_entries():
+    matches = MatchList(2, 9, 1, 1)
+    rs = np.array([0, 1, 1], dtype=np.int32)
+    cells = np.array([8, 0, 8], dtype=np.int32)
+    matches.add_all(rs, cells)
+    matches.unmark_all(rs[:2], cells[:2])
+    assert len(matches) == 3
+    assert [matches.contains(r, i) for r, i in zip(rs.tolist(), cells.tolist())] == [False, False, True]
+
+
+def test_decode():
+    matches = MatchList(1, 3, 2, 2)
+    matches.add_all(np.array([0, 0], dtype=np.int32), np.array([4, 11], dtype=np.int32))
+    rs, xs, ys, zs = matches.decode()
+    assert (rs.tolist(), xs.tolist(), ys.tolist(), zs.tolist()) == ([0, 0], [1, 2], [1, 1], [0, 1])
+    rs, xs, ys, zs = matches.decode(np.array([1]))
+    assert (xs.tolist(), ys.tolist(), zs.tolist()) == ([2], [1], [1])